@@ -0,0 +1,658 @@
+"""Micro-benchmarks for the hot paths of the training and generation loops.
+
+Each benchmark is a sub-command which builds the model from the default config with
+random weights and prints a small table of the timings, eg:
+
+    python scripts/benchmark.py context_cache --batch_size 1000
+"""
+
+import pyrootutils
+
+root = pyrootutils.setup_root(search_from=__file__, pythonpath=True)
+
+import argparse
+import time
+from contextlib import nullcontext
+from functools import partial
+from typing import Callable, Iterable, Optional
+
+import hydra
+import jetnet.evaluation as jetnet_eval
+import numpy as np
+import torch as T
+from omegaconf import OmegaConf
+from torch.utils.data import DataLoader, TensorDataset
+
+from src.datamodules.bucketing import MultiplicityBucketSampler, trim_collate
+from src.datamodules.loaders import TensorBatchLoader
+from src.metrics import w1m, w1p
+from src.models.diffusion import run_sampler
+from src.models.modules import IterativeNormLayer
+from src.models.pc_jedi import TransformerDiffusionGenerator
+from src.models.transformers import (
+    MultiHeadedAttentionBlock,
+    attention,
+    fused_attention,
+    merge_masks,
+)
+from src.physics import jet_kinematics
+from src.plotting import CST_BINS, multi_histogram
+from src.torch_utils import BatchBuffer, to_np
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("benchmark", choices=list(BENCHMARKS))
+    parser.add_argument("--batch_size", type=int, default=1000)
+    parser.add_argument("--n_nodes", type=int, default=30)
+    parser.add_argument("--n_steps", type=int, default=50)
+    parser.add_argument("--n_repeats", type=int, default=5)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--ckpt", help="Use trained weights instead of random ones")
+    parser.add_argument(
+        "--ref_ckpt", help="Reference model of distill, by default the teacher"
+    )
+    return parser.parse_args()
+
+
+def build_model(device: str = "cpu", ckpt: Optional[str] = None, **overrides):
+    """Build the diffusion generator from the default model config with the
+    JetNet input dimensions, or load it from a trained checkpoint."""
+    if ckpt is not None:
+        model = TransformerDiffusionGenerator.load_from_checkpoint(
+            ckpt, map_location=device
+        )
+        return model.to(device).eval()
+    cfg = OmegaConf.load(root / "configs" / "model" / "default.yaml")
+    cfg = OmegaConf.merge(cfg, overrides)
+    model = hydra.utils.instantiate(cfg, pc_dim=3, n_nodes=30, ctxt_dim=2)
+    return model.to(device).eval()
+
+
+def random_inputs(batch_size: int, n_nodes: int, device: str = "cpu") -> tuple:
+    """Return a random mask with a realistic spread of multiplicities and
+    normalised context."""
+    mult = T.randint(5, n_nodes + 1, (batch_size, 1), device=device)
+    mask = T.arange(n_nodes, device=device) < mult
+    ctxt = T.randn(batch_size, 2, device=device)
+    return mask, ctxt
+
+
+def time_fn(fn: Callable, n_repeats: int = 5, n_warmup: int = 1) -> float:
+    """Return the best wall time of a function in seconds."""
+    for _ in range(n_warmup):
+        fn()
+    times = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def print_table(rows: list) -> None:
+    """Print a list of (name, seconds) rows with the speedup to the first."""
+    print(f"{'method':<30}{'time [ms]':>12}{'speedup':>10}")
+    for name, secs in rows:
+        print(f"{name:<30}{1e3 * secs:>12.2f}{rows[0][1] / secs:>10.2f}")
+
+
+def bench_context_cache(args: argparse.Namespace) -> None:
+    """Compare the sampler with and without the cached context embedding."""
+    model = build_model(args.device)
+    mask, ctxt = random_inputs(args.batch_size, args.n_nodes, args.device)
+    noise = T.randn((*mask.shape, 3), device=args.device) * mask.unsqueeze(-1)
+
+    def sample(cache: bool) -> T.Tensor:
+        with model.cached_context(ctxt) if cache else nullcontext():
+            return run_sampler(
+                "euler",
+                model,
+                model.diff_sched,
+                initial_noise=noise.clone(),
+                n_steps=args.n_steps,
+                mask=mask,
+                ctxt=ctxt,
+            )[0]
+
+    print(f"Max abs difference: {(sample(False) - sample(True)).abs().max():.2e}")
+    print_table(
+        [
+            ("euler (full context)", time_fn(partial(sample, False), args.n_repeats)),
+            ("euler (cached context)", time_fn(partial(sample, True), args.n_repeats)),
+        ]
+    )
+
+
+def bench_attention(args: argparse.Namespace) -> None:
+    """Check that the fused attention backend matches the explicit one and
+    compare their throughput."""
+
+    # Numerical equivalence, including fully padded jets and an attention bias
+    mask, _ = random_inputs(args.batch_size, args.n_nodes, args.device)
+    mask[:2] = False
+    q, k, v = T.randn(3, args.batch_size, 8, args.n_nodes, 16, device=args.device)
+    bias = T.randn(args.batch_size, args.n_nodes, args.n_nodes, 8, device=args.device)
+    attn_mask = merge_masks(mask, mask, None, q.shape, k.shape, args.device)
+    for attn_bias in [None, bias]:
+        expected = attention(q, k, v, 16, attn_mask, attn_bias, training=False)
+        result = fused_attention(q, k, v, attn_mask, attn_bias, training=False)
+        assert not T.isnan(result).any()
+        T.testing.assert_close(result, expected, atol=1e-5, rtol=1e-4)
+    print("Fused attention matches the explicit attention")
+
+    # Throughput of the full block using the same weights
+    x = T.randn(args.batch_size, args.n_nodes, 128, device=args.device)
+    rows = []
+    for backend in ["math", "fused"]:
+        T.manual_seed(0)
+        mha = MultiHeadedAttentionBlock(128, 8, backend=backend).to(args.device)
+        fn = partial(mha, x, q_mask=mask)
+        rows.append((f"attention ({backend})", time_fn(fn, args.n_repeats)))
+    print_table(rows)
+
+
+def bench_fused_qkv(args: argparse.Namespace) -> None:
+    """Compare the self attention block with seperate and fused projections."""
+    mask, _ = random_inputs(args.batch_size, args.n_nodes, args.device)
+    x = T.randn(args.batch_size, args.n_nodes, 128, device=args.device)
+    seperate = MultiHeadedAttentionBlock(128, 8).to(args.device)
+    fused = MultiHeadedAttentionBlock(128, 8, fuse_qkv=True).to(args.device)
+    fused.load_state_dict(seperate.state_dict())
+    diff = (seperate(x, q_mask=mask) - fused(x, q_mask=mask)).abs().max()
+    print(f"Max abs difference: {diff:.2e}")
+    print_table(
+        [
+            (
+                "seperate qkv",
+                time_fn(partial(seperate, x, q_mask=mask), args.n_repeats),
+            ),
+            ("fused qkv", time_fn(partial(fused, x, q_mask=mask), args.n_repeats)),
+        ]
+    )
+
+
+def bench_samplers(args: argparse.Namespace) -> None:
+    """Compare the deterministic samplers by the number of network evaluations,
+    the time and the distance to a fine grained Runge-Kutta solution.
+
+    The distances are only meaningful for trained weights, see --ckpt.
+    """
+    model = build_model(args.device, args.ckpt)
+    mask, ctxt = random_inputs(args.batch_size, args.n_nodes, args.device)
+    noise = T.randn((*mask.shape, 3), device=args.device) * mask.unsqueeze(-1)
+
+    # Count the number of forward passes through the model
+    n_evals = 0
+    forward = model.forward
+
+    def counting_forward(*fargs, **fkwargs) -> T.Tensor:
+        nonlocal n_evals
+        n_evals += 1
+        return forward(*fargs, **fkwargs)
+
+    model.forward = counting_forward
+
+    def sample(sampler: str, n_steps: int) -> T.Tensor:
+        with model.cached_context(ctxt):
+            return run_sampler(
+                sampler,
+                model,
+                model.diff_sched,
+                initial_noise=noise.clone(),
+                n_steps=n_steps,
+                mask=mask,
+                ctxt=ctxt,
+            )[0]
+
+    reference = sample("rk", 500)
+    print(f"{'method':<30}{'NFE':>8}{'time [ms]':>12}{'RMSE':>12}")
+    runs = [
+        (sampler, n_steps)
+        for sampler in ["euler", "ddim", "lms", "dpm2m", "dpm3m", "rk"]
+        for n_steps in [10, 20, args.n_steps]
+    ]
+    runs.append(("adaptive", 10))  # Steps only set the size of the first trial
+    for sampler, n_steps in runs:
+        n_evals = 0
+        result = sample(sampler, n_steps)
+        nfe = n_evals
+        secs = time_fn(partial(sample, sampler, n_steps), args.n_repeats, 0)
+        rmse = (result - reference)[mask].square().mean().sqrt()
+        name = f"{sampler} ({n_steps} steps)"
+        print(f"{name:<30}{nfe:>8}{1e3 * secs:>12.2f}{rmse:>12.2e}")
+
+
+def bench_bucketing(args: argparse.Namespace) -> None:
+    """Compare the full generation with and without trimming the padded nodes
+    in buckets of jets with similar multiplicity."""
+    model = build_model(args.device, args.ckpt)
+    mask, ctxt = random_inputs(args.batch_size, args.n_nodes, args.device)
+    noise = T.randn((*mask.shape, 3), device=args.device)
+
+    def generate(bucket_size: Optional[int]) -> T.Tensor:
+        return model.full_generation(
+            "euler",
+            args.n_steps,
+            mask=mask,
+            ctxt=ctxt,
+            initial_noise=noise,
+            bucket_size=bucket_size,
+        )
+
+    diff = (generate(None) - generate(args.batch_size // 4)).abs().max()
+    print(f"Max abs difference: {diff:.2e}")
+    print(f"Fraction of real nodes: {mask.float().mean():.2f}")
+    rows = [("padded", time_fn(partial(generate, None), args.n_repeats))]
+    for n_buckets in [1, 4, 10]:
+        bucket_size = -(-args.batch_size // n_buckets)
+        fn = partial(generate, bucket_size)
+        rows.append((f"{n_buckets} buckets", time_fn(fn, args.n_repeats)))
+    print_table(rows)
+
+
+def bench_bucket_sampler(args: argparse.Namespace) -> None:
+    """Compare the time of a training epoch using uniform shuffling and the
+    multiplicity bucket sampler."""
+    model = build_model(args.device).train()
+    opt = T.optim.Adam(model.parameters())
+
+    # A small dataset of ten batches with random multiplicities
+    mask, ctxt = random_inputs(10 * args.batch_size, args.n_nodes)
+    csts = T.randn((*mask.shape, 3)) * mask.unsqueeze(-1)
+    dataset = TensorDataset(csts, mask, ctxt)
+
+    def run_epoch(loader: DataLoader) -> None:
+        for sample in loader:
+            sample = [x.to(args.device) for x in sample]
+            loss = model._shared_step(sample)[0]
+            opt.zero_grad(set_to_none=True)
+            loss.backward()
+            opt.step()
+
+    # Keep the incomplete batches so every loader covers the full epoch
+    loaders = {"uniform": DataLoader(dataset, args.batch_size, shuffle=True)}
+    for boundaries in [[10, 20], [10, 15, 20, 25]]:
+        sampler = MultiplicityBucketSampler(
+            mask.sum(dim=-1).numpy(), args.batch_size, boundaries, drop_last=False
+        )
+        loaders[f"{len(boundaries) + 1} buckets"] = DataLoader(
+            dataset, batch_sampler=sampler, collate_fn=trim_collate
+        )
+
+    with T.enable_grad():
+        print_table(
+            [
+                (f"{name} ({len(loader)} batches)", time_fn(partial(run_epoch, loader)))
+                for name, loader in loaders.items()
+            ]
+        )
+
+
+def bench_loader(args: argparse.Namespace) -> None:
+    """Compare the time to iterate over an epoch with the DataLoader of single
+    items and slicing the batches from the in-memory tensors."""
+    mask, ctxt = random_inputs(100 * args.batch_size, args.n_nodes)
+    csts = T.randn((*mask.shape, 3)) * mask.unsqueeze(-1)
+    dataset = TensorDataset(csts, mask, ctxt)
+
+    def run_epoch(loader: Iterable) -> None:
+        for _ in loader:
+            pass
+
+    loaders = {
+        f"DataLoader ({n} workers)": DataLoader(
+            dataset, args.batch_size, shuffle=True, num_workers=n
+        )
+        for n in [0, 2]
+    }
+    loaders["TensorBatchLoader"] = TensorBatchLoader(
+        (csts, mask, ctxt), args.batch_size, shuffle=True
+    )
+    print_table(
+        [
+            (name, time_fn(partial(run_epoch, loader), args.n_repeats))
+            for name, loader in loaders.items()
+        ]
+    )
+
+
+def bench_normaliser(args: argparse.Namespace) -> None:
+    """Compare the training forward pass of the normaliser while it is updating
+    its stats and once it has been frozen by the streaming fit."""
+    mask, _ = random_inputs(args.batch_size, args.n_nodes, args.device)
+    nodes = T.randn((*mask.shape, 3), device=args.device)
+
+    updating = IterativeNormLayer((3,), max_n=10**12).to(args.device).train()
+    updating(nodes, mask)
+    frozen = IterativeNormLayer((3,)).to(args.device).train()
+    frozen.fit_stream([(nodes, mask)])
+    print_table(
+        [
+            ("updating", time_fn(partial(updating, nodes, mask), args.n_repeats)),
+            ("frozen", time_fn(partial(frozen, nodes, mask), args.n_repeats)),
+        ]
+    )
+
+
+def bench_ema(args: argparse.Namespace) -> None:
+    """Compare the ema update using a python loop over the parameters with the
+    multi-tensor kernels, with ema_every=k the cost per step is divided by k."""
+    model = build_model(args.device).train()
+
+    def loop_update() -> None:
+        for params, ema_params in zip(
+            model.net.parameters(), model.ema_net.parameters()
+        ):
+            ema_params.data.copy_(
+                model.ema_sync * ema_params.data + (1.0 - model.ema_sync) * params.data
+            )
+
+    rows = [
+        ("python loop", time_fn(loop_update, args.n_repeats)),
+        ("foreach", time_fn(model._sync_ema_network, args.n_repeats)),
+    ]
+    model.ema_device = "cpu"
+    model.ema_dtype = T.float64
+    model._init_ema_shadow()
+    rows.append(("foreach (cpu float64)", time_fn(model._sync_ema_network)))
+    print_table(rows)
+
+
+def bench_metrics(args: argparse.Namespace) -> None:
+    """Compare the bootstrapped W1 metrics of jetnet with the vectorised ones
+    using 50 batches of random jets, the two values should agree within the
+    bootstrap errors."""
+    jets = []
+    for scale in [1.0, 1.1]:
+        mask, _ = random_inputs(50 * args.batch_size, args.n_nodes)
+        csts = T.rand((*mask.shape, 3)) - T.tensor([0.5, 0.5, 0.0])
+        csts[..., 2] *= scale
+        jets.append((csts * mask.unsqueeze(-1)).numpy())
+    bootstrap = {"num_eval_samples": len(jets[0]), "num_batches": 5}
+
+    for name, jetnet_fn, new_fn in [
+        ("w1m", jetnet_eval.w1m, w1m),
+        ("w1p", jetnet_eval.w1p, w1p),
+    ]:
+        jetnet_val = np.mean(jetnet_fn(*jets, **bootstrap)[0])
+        new_val = np.mean(new_fn(*jets, **bootstrap)[0])
+        print(f"{name}: jetnet {jetnet_val:.5f}, vectorised {new_val:.5f}")
+        print_table(
+            [
+                ("jetnet", time_fn(partial(jetnet_fn, *jets, **bootstrap), 1, 0)),
+                ("vectorised", time_fn(partial(new_fn, *jets, **bootstrap), 1, 0)),
+            ]
+        )
+
+
+def bench_histograms(args: argparse.Namespace) -> None:
+    """Compare binning the constituent marginals of the real and generated jets
+    with automatic bins against only the generated jets with the fixed bins."""
+    mask, _ = random_inputs(10 * args.batch_size, args.n_nodes)
+    real, gen = (T.rand((2, *mask.shape, 3)) * mask.unsqueeze(-1))[:, mask].numpy()
+
+    def auto_hists() -> None:
+        for col in range(real.shape[-1]):
+            edges = np.histogram_bin_edges(real[:, col], bins="auto")
+            for data in [real, gen]:
+                np.histogram(data[:, col], edges)
+
+    print_table(
+        [
+            ("auto (both)", time_fn(auto_hists, args.n_repeats)),
+            ("fixed (generated)", time_fn(partial(multi_histogram, gen, CST_BINS))),
+        ]
+    )
+
+
+def bench_val_outputs(args: argparse.Namespace) -> None:
+    """Compare collecting the validation outputs by converting each batch and
+    stacking at the end with copying them into the preallocated buffer."""
+    mask, ctxt = random_inputs(args.batch_size, args.n_nodes, args.device)
+    batch = (T.randn((*mask.shape, 3), device=args.device),) * 2 + (mask, ctxt)
+    n_batches = 20
+    buffer = BatchBuffer(n_batches * args.batch_size)
+
+    def stack_outputs() -> tuple:
+        outs = [to_np(batch) for _ in range(n_batches)]
+        return tuple(np.vstack([o[i] for o in outs]) for i in range(len(batch)))
+
+    def buffer_outputs() -> tuple:
+        buffer.reset()
+        for _ in range(n_batches):
+            buffer.append(*batch)
+        return buffer.arrays()
+
+    print_table(
+        [
+            ("to_np + vstack", time_fn(stack_outputs, args.n_repeats)),
+            ("BatchBuffer", time_fn(buffer_outputs, args.n_repeats)),
+        ]
+    )
+
+
+def bench_kinematics(args: argparse.Namespace) -> None:
+    """Compare the jet pt and mass calculated over the full padded arrays with
+    the kernel which only uses the valid constituents, on 1000 batches of jets
+    (1M with the default batch size). The gain grows with the fraction of
+    padding, eg: --n_nodes 150."""
+    mask, _ = random_inputs(1000 * args.batch_size, args.n_nodes)
+    csts = ((T.rand((*mask.shape, 3)) - 0.5) * mask.unsqueeze(-1)).numpy()
+    mask = mask.numpy()
+
+    def padded_kinematics() -> np.ndarray:
+        eta, phi, pt = csts[..., 0], csts[..., 1], csts[..., 2]
+        jet_px = (pt * np.cos(phi) * mask).sum(axis=-1)
+        jet_py = (pt * np.sin(phi) * mask).sum(axis=-1)
+        jet_pz = (pt * np.sinh(eta) * mask).sum(axis=-1)
+        jet_e = (pt * np.cosh(eta) * mask).sum(axis=-1)
+        jet_pt = np.sqrt(np.clip(jet_px**2 + jet_py**2, 0, None))
+        jet_m = np.sqrt(
+            np.clip(jet_e**2 - jet_px**2 - jet_py**2 - jet_pz**2, 0, None)
+        )
+        return np.vstack([jet_pt, jet_m]).T
+
+    kinematics = partial(jet_kinematics, csts, mask)
+    print_table(
+        [
+            ("padded numpy", time_fn(padded_kinematics, args.n_repeats)),
+            ("valid only (one chunk)", time_fn(partial(kinematics, chunk_size=None))),
+            ("valid only", time_fn(kinematics)),
+            ("valid only (float64)", time_fn(partial(kinematics, double=True))),
+        ]
+    )
+
+
+def bench_autocast(args: argparse.Namespace) -> None:
+    """Compare the generation speed in full and reduced precision, with the W1
+    distance between the features of the jets generated from the same noise."""
+    model = build_model(args.device, args.ckpt)
+    mask, ctxt = random_inputs(args.batch_size, args.n_nodes, args.device)
+    noise = T.randn((*mask.shape, model.pc_dim), device=args.device)
+
+    rows = []
+    outputs = {}
+    for dtype in [None, "bfloat16", "float16"]:
+        model.autocast_dtype = getattr(T, dtype) if dtype else None
+        generate = partial(
+            model.full_generation,
+            "euler",
+            args.n_steps,
+            mask=mask,
+            ctxt=ctxt,
+            initial_noise=noise,
+        )
+        name = dtype or "float32"
+        rows.append((name, time_fn(generate, args.n_repeats)))
+        outputs[name] = generate()[mask].cpu().numpy()
+    print_table(rows)
+
+    # Same number of values so the exact W1 is the mean difference when sorted
+    reference = np.sort(outputs["float32"], axis=0)
+    for name, output in outputs.items():
+        w1 = np.abs(np.sort(output, axis=0) - reference).mean(axis=0)
+        print(f"{name}: W1 to float32 per feature {np.round(w1, 5)}")
+
+
+def bench_quantize(args: argparse.Namespace) -> None:
+    """Compare generation on CPU with the full precision and the INT8 ema network.
+
+    As a regression check the W1m and W1p between the outputs of the two networks
+    (from the same noise) must be within the bootstrap errors of those between
+    two full precision runs with different noise. This is only meaningful with
+    trained weights (--ckpt) and is done in the output space of the model.
+    """
+    model = build_model("cpu", args.ckpt)
+    mask, ctxt = random_inputs(args.batch_size, args.n_nodes)
+    noises = T.randn((2, *mask.shape, model.pc_dim))
+
+    def generate(noise: T.Tensor) -> T.Tensor:
+        outputs = model.full_generation(
+            "euler", args.n_steps, mask=mask, ctxt=ctxt, initial_noise=noise
+        )
+        return (outputs * mask.unsqueeze(-1)).numpy()
+
+    rows = [("float32", time_fn(partial(generate, noises[0]), args.n_repeats))]
+    fp32_jets = [generate(noise) for noise in noises]
+    model.quantize_ema_network()
+    rows.append(
+        ("int8 (dynamic)", time_fn(partial(generate, noises[0]), args.n_repeats))
+    )
+    int8_jets = generate(noises[0])
+    print_table(rows)
+
+    bootstrap = {"num_eval_samples": len(mask), "num_batches": 5}
+    for name, w1_fn in [("w1m", w1m), ("w1p", w1p)]:
+        ref_val, ref_err = (np.mean(x) for x in w1_fn(*fp32_jets, **bootstrap))
+        int8_val = np.mean(w1_fn(fp32_jets[0], int8_jets, **bootstrap)[0])
+        result = "PASS" if int8_val <= ref_val + ref_err else "FAIL"
+        print(
+            f"{name}: float32 to int8 {int8_val:.5f}, float32 to float32 with other"
+            f" noise {ref_val:.5f} +- {ref_err:.5f} [{result}]"
+        )
+
+
+def bench_compile(args: argparse.Namespace) -> None:
+    """Compare the latency per step of the eager and compiled samplers and check
+    that they generate the same jets from the same noise.
+
+    The compilation happens on the first (warmup) call and is timed seperately.
+    """
+    model = build_model(args.device, args.ckpt)
+    mask, ctxt = random_inputs(args.batch_size, args.n_nodes, args.device)
+    noise = T.randn((*mask.shape, model.pc_dim), device=args.device)
+
+    for sampler in ["euler", "rk", "ddim"]:
+        generate = partial(
+            model.full_generation,
+            sampler,
+            args.n_steps,
+            mask=mask,
+            ctxt=ctxt,
+            initial_noise=noise,
+        )
+        start = time.perf_counter()
+        compiled_jets = generate(compile_step=True)
+        print(f"{sampler}: compiled in {time.perf_counter() - start:.1f} s")
+        print_table(
+            [
+                (
+                    f"{sampler} (eager) per step",
+                    time_fn(generate, args.n_repeats) / args.n_steps,
+                ),
+                (
+                    f"{sampler} (compiled) per step",
+                    time_fn(partial(generate, compile_step=True), args.n_repeats)
+                    / args.n_steps,
+                ),
+            ]
+        )
+
+        # Parity with eager mode, only the rounding of the compiled kernels differs
+        max_diff = (compiled_jets - generate())[mask].abs().max().item()
+        result = "PASS" if max_diff < 1e-3 else "FAIL"
+        print(f"{sampler}: max abs difference to eager {max_diff:.2e} {result}")
+
+
+def bench_distill(args: argparse.Namespace) -> None:
+    """Check a distilled student (--ckpt) against the reference model (--ref_ckpt,
+    by default its teacher) which uses DDIM with --n_steps, or its own grid if it
+    was also distilled.
+
+    As a regression check the W1m and W1p between the outputs of the two (from the
+    same noise) must be within the bootstrap errors of those between two runs of
+    the reference with different noise. The reference DDIM sampler with the steps
+    of the student is shown for comparison.
+    """
+    student = build_model("cpu", args.ckpt)
+    reference = build_model(
+        "cpu", args.ref_ckpt or student.distill_config["teacher_ckpt"]
+    )
+    mask, ctxt = random_inputs(args.batch_size, args.n_nodes)
+    noises = T.randn((2, *mask.shape, student.pc_dim))
+
+    # The context is given unnormalised, so it stays in the trained range
+    if student.ctxt_dim:
+        ctxt = student.ctxt_normaliser.reverse(ctxt)
+
+    def generate(model, sampler: str, n_steps: int, noise: T.Tensor) -> np.ndarray:
+        outputs = model.full_generation(
+            sampler, n_steps, mask=mask, ctxt=ctxt, initial_noise=noise
+        )
+        return (outputs * mask.unsqueeze(-1)).numpy()
+
+    # The reference samples, a distilled model can only use its own grid
+    if reference.distill_config is not None:
+        ref_sampler, ref_steps = "distilled", reference.sampler_steps
+    else:
+        ref_sampler, ref_steps = "ddim", args.n_steps
+    ref_jets = [generate(reference, ref_sampler, ref_steps, n) for n in noises]
+    candidates = {
+        f"student ({student.sampler_steps} steps)": generate(
+            student, "distilled", student.sampler_steps, noises[0]
+        )
+    }
+    if reference.distill_config is None:
+        candidates[f"reference ddim ({student.sampler_steps} steps)"] = generate(
+            reference, "ddim", student.sampler_steps, noises[0]
+        )
+
+    bootstrap = {"num_eval_samples": len(mask), "num_batches": 5}
+    for name, w1_fn in [("w1m", w1m), ("w1p", w1p)]:
+        ref_val, ref_err = (np.mean(x) for x in w1_fn(*ref_jets, **bootstrap))
+        print(
+            f"{name}: reference ({ref_steps} steps) with other noise "
+            f"{ref_val:.5f} +- {ref_err:.5f}"
+        )
+        for label, jets in candidates.items():
+            val = np.mean(w1_fn(ref_jets[0], jets, **bootstrap)[0])
+            result = "PASS" if val <= ref_val + ref_err else "FAIL"
+            print(f"{name}: {label} {val:.5f} [{result}]")
+
+
+BENCHMARKS = {
+    "context_cache": bench_context_cache,
+    "attention": bench_attention,
+    "fused_qkv": bench_fused_qkv,
+    "samplers": bench_samplers,
+    "bucketing": bench_bucketing,
+    "bucket_sampler": bench_bucket_sampler,
+    "loader": bench_loader,
+    "normaliser": bench_normaliser,
+    "ema": bench_ema,
+    "metrics": bench_metrics,
+    "histograms": bench_histograms,
+    "val_outputs": bench_val_outputs,
+    "kinematics": bench_kinematics,
+    "autocast": bench_autocast,
+    "quantize": bench_quantize,
+    "compile": bench_compile,
+    "distill": bench_distill,
+}
+
+
+if __name__ == "__main__":
+    args = get_args()
+    with T.no_grad():
+        BENCHMARKS[args.benchmark](args)
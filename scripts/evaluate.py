@@ -0,0 +1,142 @@
+import pyrootutils
+
+root = pyrootutils.setup_root(search_from=__file__, pythonpath=True)
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Callable
+
+import h5py
+import hydra
+import numpy as np
+import pytorch_lightning as pl
+from jetnet.datasets import JetNet
+from jetnet.evaluation import fpd, get_fpd_kpd_jet_features, kpd
+from omegaconf import DictConfig, OmegaConf
+
+from src.evaluation import compute_efps, prepare_for_metrics
+from src.metrics import bootstrap_w1, w1efp, w1p
+from src.physics import numpy_locals_to_mass_and_pt
+
+log = logging.getLogger(__name__)
+
+# Increment when the reference features change to invalidate the old caches
+CACHE_VERSION = 2
+
+
+def cached(path: Path, fn: Callable) -> np.ndarray:
+    """Load an array from the path or calculate and save it there first."""
+    if not path.exists():
+        log.info(f"Caching the reference features to {path}")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp.npy")
+        np.save(tmp_path, fn())
+        os.replace(tmp_path, path)
+    return np.load(path)
+
+
+def jet_masses(csts: np.ndarray) -> np.ndarray:
+    """The jet mass as used by the W1m metric."""
+    return numpy_locals_to_mass_and_pt(csts, csts[..., 2] != 0)[:, 1:]
+
+
+def load_reference(cfg: DictConfig, data_conf: DictConfig) -> np.ndarray:
+    """Return the real jets of the requested split in the jetnet format."""
+    csts, _ = JetNet.getData(
+        jet_type=data_conf.jet_type,
+        data_dir=data_conf.data_dir,
+        particle_features=list(data_conf.particle_features),
+        jet_features=list(data_conf.jet_features),
+        num_particles=data_conf.num_particles,
+        split=cfg.split,
+        split_fraction=list(data_conf.split_fraction),
+    )
+    csts = csts[: cfg.n_jets].astype(np.float32)
+    return prepare_for_metrics(csts, None, False)
+
+
+def get_metrics(
+    cfg: DictConfig, gen: tuple, real: tuple, gen_feats: dict, real_feats: dict
+) -> dict:
+    """Calculate all metrics between the generated and the real jets."""
+    bootstrap = {
+        "num_eval_samples": cfg.num_eval_samples,
+        "num_batches": cfg.num_batches,
+        "rng": np.random.default_rng(cfg.seed),
+    }
+    metrics = {}
+
+    w1m_val, w1m_err = bootstrap_w1(real_feats["mass"], gen_feats["mass"], **bootstrap)
+    metrics["w1m"], metrics["w1m_err"] = w1m_val[0], w1m_err[0]
+
+    w1p_val, w1p_err = w1p(real[0], gen[0], real[1], gen[1], **bootstrap)
+    metrics["w1p"], metrics["w1p_err"] = w1p_val.mean(), w1p_err.mean()
+
+    w1efp_val, w1efp_err = w1efp(real_feats["efps"], gen_feats["efps"], **bootstrap)
+    metrics["w1efp"], metrics["w1efp_err"] = w1efp_val.mean(), w1efp_err.mean()
+
+    if cfg.do_fpd_kpd:
+        metrics["fpd"], metrics["fpd_err"] = fpd(real_feats["fpd"], gen_feats["fpd"])
+        metrics["kpd"], metrics["kpd_err"] = kpd(real_feats["fpd"], gen_feats["fpd"])
+
+    return {k: float(v) for k, v in metrics.items()}
+
+
+@hydra.main(
+    version_base=None, config_path=str(root / "configs"), config_name="evaluate.yaml"
+)
+def main(cfg: DictConfig) -> None:
+
+    log.info("Loading the original training config")
+    model_dir = Path(cfg.paths.full_path)
+    orig_cfg = OmegaConf.load(model_dir / "full_config.yaml")
+    data_conf = orig_cfg.datamodule.data_conf
+
+    if cfg.seed:
+        log.info(f"Setting seed to: {cfg.seed}")
+        pl.seed_everything(cfg.seed, workers=True)
+
+    # The functions for each feature set, FPD/KPD uses the recommended EFPs
+    feature_fns = {
+        "mass": jet_masses,
+        "efps": lambda csts: compute_efps(csts, cfg.efp_jobs),
+    }
+    if cfg.do_fpd_kpd:
+        feature_fns["fpd"] = lambda csts: get_fpd_kpd_jet_features(csts, efp_jobs=1)
+
+    # Every setting which changes the reference jets goes into the key
+    log.info("Loading the reference jets and their cached features")
+    ref_conf = {
+        "version": CACHE_VERSION,
+        "split": cfg.split,
+        "n_jets": cfg.n_jets,
+        "data_conf": OmegaConf.to_container(data_conf, resolve=True),
+    }
+    ref_conf = json.dumps(ref_conf, sort_keys=True)
+    ref_dir = Path(cfg.cache_dir) / hashlib.sha1(ref_conf.encode()).hexdigest()
+    real_csts = cached(ref_dir / "csts.npy", lambda: load_reference(cfg, data_conf))
+    real = (real_csts, ~np.all(real_csts == 0, axis=-1))
+    real_feats = {
+        name: cached(ref_dir / f"{name}.npy", lambda fn=fn: fn(real[0]))
+        for name, fn in feature_fns.items()
+    }
+
+    for output_name in cfg.output_names:
+        log.info(f"Evaluating the generated jets in {output_name}")
+        with h5py.File(model_dir / "outputs" / f"{output_name}.h5", "r") as file:
+            csts = file["csts"][: cfg.n_jets]
+            mask = file["mask"][: cfg.n_jets]
+        gen = (prepare_for_metrics(csts, None, False), mask)
+        gen_feats = {name: fn(gen[0]) for name, fn in feature_fns.items()}
+
+        metrics = get_metrics(cfg, gen, real, gen_feats, real_feats)
+        for name, value in metrics.items():
+            log.info(f"{name}: {value:.4g}")
+        OmegaConf.save(metrics, model_dir / "outputs" / f"{output_name}_metrics.yaml")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import pyrootutils
+
+root = pyrootutils.setup_root(search_from=__file__, pythonpath=True)
+
+import json
+import logging
+import warnings
+from pathlib import Path
+
+import hydra
+import pytorch_lightning as pl
+import torch as T
+import torch.nn as nn
+from omegaconf import DictConfig, OmegaConf
+
+from src.runtime import ExportedGenerator
+
+log = logging.getLogger(__name__)
+
+
+class ExportedDenoiser(nn.Module):
+    """The parts of the generator needed for sampling with the methods used by
+    src.runtime.ExportedGenerator, so they can be traced together."""
+
+    def __init__(self, model: nn.Module) -> None:
+        super().__init__()
+        self.ctxt_dim = model.ctxt_dim
+        self.net = model.ema_net
+        self.normaliser = model.normaliser
+        self.ctxt_normaliser = model.ctxt_normaliser if model.ctxt_dim else None
+        self.time_encoder = model.time_encoder
+        self.diff_sched = model.diff_sched
+        self.predicts_velocity = model.distill_config is not None
+
+    def forward(
+        self,
+        noisy_data: T.Tensor,
+        diffusion_times: T.Tensor,
+        mask: T.BoolTensor,
+        ctxt_cache: T.Tensor,
+    ) -> T.Tensor:
+        """Estimate the noise using the precomputed context embedding."""
+        context = self.time_encoder(diffusion_times)
+        if self.ctxt_dim:
+            outputs = self.net(
+                noisy_data, mask=mask, ctxt=context, ctxt_cache=ctxt_cache
+            )
+        else:
+            outputs = self.net(noisy_data, mask=mask, ctxt=context)
+
+        # A distilled student predicts the velocity, which is converted to the noise
+        if self.predicts_velocity:
+            signal_rates, noise_rates = self.diff_sched(diffusion_times.view(-1, 1, 1))
+            outputs = signal_rates * outputs + noise_rates * noisy_data
+        return outputs
+
+    def embed_ctxt(self, ctxt: T.Tensor) -> T.Tensor:
+        """Normalise and embed the static context."""
+        return self.net.embed_static_ctxt(self.ctxt_normaliser(ctxt))
+
+    def reverse(self, nodes: T.Tensor, mask: T.BoolTensor) -> T.Tensor:
+        """Undo the normalisation of the generated nodes."""
+        return self.normaliser.reverse(nodes, mask=mask)
+
+
+def random_inputs(model: nn.Module, batch_size: int, n_nodes: int) -> tuple:
+    """Return a random mask, noise and normalised context for tracing."""
+    mask = T.arange(n_nodes) < T.randint(1, n_nodes + 1, (batch_size, 1))
+    noise = T.randn((batch_size, n_nodes, model.pc_dim))
+    ctxt = T.randn((batch_size, model.ctxt_dim))
+    if model.ctxt_dim:
+        ctxt = model.ctxt_normaliser.reverse(ctxt)
+    return mask, noise, ctxt
+
+
+@hydra.main(
+    version_base=None, config_path=str(root / "configs"), config_name="export.yaml"
+)
+def main(cfg: DictConfig) -> None:
+
+    log.info("Loading the original training config")
+    model_dir = Path(cfg.paths.full_path)
+    orig_cfg = OmegaConf.load(model_dir / "full_config.yaml")
+
+    if cfg.seed:
+        log.info(f"Setting seed to: {cfg.seed}")
+        pl.seed_everything(cfg.seed, workers=True)
+
+    log.info("Loading the model checkpoint")
+    ckpt_path = sorted((model_dir / "checkpoints").glob(f"{cfg.ckpt_flag}*.ckpt"))[-1]
+    model_class = hydra.utils.get_class(orig_cfg.model._target_)
+    model = model_class.load_from_checkpoint(ckpt_path, map_location="cpu")
+    model.eval()
+
+    # Trace every method used in sampling, the cosine encoding bound checks
+    # are only evaluated on the tracing inputs
+    log.info("Tracing the denoiser")
+    denoiser = ExportedDenoiser(model)
+    mask, noise, ctxt = random_inputs(model, 16, model.n_nodes)
+    times = T.rand(len(mask))
+    methods = {"reverse": (noise, mask)}
+    if model.ctxt_dim:
+        methods["embed_ctxt"] = (ctxt,)
+        ctxt_cache = denoiser.embed_ctxt(ctxt)
+    else:
+        ctxt_cache = T.zeros((len(mask), 0))
+    methods["forward"] = (noise, times, mask, ctxt_cache)
+    with T.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter("ignore", T.jit.TracerWarning)
+        traced = T.jit.trace_module(denoiser, methods)
+
+    # Everything else needed by the runtime is saved alongside as json
+    config = {
+        "pc_dim": model.pc_dim,
+        "ctxt_dim": model.ctxt_dim,
+        "n_nodes": model.n_nodes,
+        "diff_config": {
+            "max_sr": model.diff_sched.max_sr,
+            "min_sr": model.diff_sched.min_sr,
+        },
+        "sampler_name": model.sampler_name,
+        "sampler_steps": model.sampler_steps,
+        "data_conf": OmegaConf.to_container(orig_cfg.datamodule.data_conf),
+    }
+    out_path = model_dir / f"{cfg.output_name}.pt"
+    log.info(f"Saving the exported denoiser to {out_path}")
+    T.jit.save(traced, str(out_path), _extra_files={"config.json": json.dumps(config)})
+
+    # Check on new shapes that the runtime reproduces the original generation
+    generator = ExportedGenerator(out_path)
+    mask, noise, ctxt = random_inputs(model, 7, model.n_nodes - 1)
+    with T.no_grad():
+        expected = model.full_generation(
+            "euler", cfg.check_steps, mask=mask, ctxt=ctxt, initial_noise=noise
+        )
+    outputs = generator.full_generation(
+        "euler", cfg.check_steps, mask=mask, ctxt=ctxt, initial_noise=noise
+    )
+    log.info(
+        f"Max difference to the original model: {(outputs - expected).abs().max():.3g}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import pyrootutils
+
+root = pyrootutils.setup_root(search_from=__file__, pythonpath=True)
+
+import logging
+import time
+from pathlib import Path
+from typing import Iterator
+
+import h5py
+import hydra
+import numpy as np
+import pytorch_lightning as pl
+import torch as T
+from omegaconf import DictConfig, OmegaConf
+from torch.utils.data import DataLoader
+
+from src.numpy_utils import undo_log_squash
+from src.torch_utils import to_np
+
+log = logging.getLogger(__name__)
+
+
+def cycle_loader(loader: DataLoader) -> Iterator:
+    """Loop over the dataloader indefinitely, so we can generate more jets
+    than are in the split."""
+    while True:
+        yield from loader
+
+
+def append_to_file(file: h5py.File, arrays: dict) -> None:
+    """Append a collection of arrays to the resizable datasets of an HDF5
+    file, creating the datasets on the first call."""
+    for name, arr in arrays.items():
+        if name not in file:
+            file.create_dataset(
+                name,
+                data=arr,
+                maxshape=(None, *arr.shape[1:]),
+                chunks=True,
+                compression="lzf",
+            )
+        else:
+            dset = file[name]
+            dset.resize(len(dset) + len(arr), axis=0)
+            dset[-len(arr) :] = arr
+
+
+@hydra.main(
+    version_base=None, config_path=str(root / "configs"), config_name="generate.yaml"
+)
+def main(cfg: DictConfig) -> None:
+
+    log.info("Loading the original training config")
+    model_dir = Path(cfg.paths.full_path)
+    orig_cfg = OmegaConf.load(model_dir / "full_config.yaml")
+
+    if cfg.seed:
+        log.info(f"Setting seed to: {cfg.seed}")
+        pl.seed_everything(cfg.seed, workers=True)
+
+    log.info("Instantiating the data module")
+    datamodule = hydra.utils.instantiate(orig_cfg.datamodule)
+    datamodule.setup("test" if cfg.split == "test" else "fit")
+    dataset = datamodule.test_set if cfg.split == "test" else datamodule.train_set
+    loader = DataLoader(
+        dataset,
+        batch_size=cfg.batch_size,
+        shuffle=False,
+        drop_last=False,
+        num_workers=0,
+    )
+    log_squash_pt = orig_cfg.datamodule.data_conf.log_squash_pt
+
+    log.info("Loading the model checkpoint")
+    ckpt_path = sorted((model_dir / "checkpoints").glob(f"{cfg.ckpt_flag}*.ckpt"))[-1]
+    model_class = hydra.utils.get_class(orig_cfg.model._target_)
+    model = model_class.load_from_checkpoint(ckpt_path, map_location="cpu")
+    model.eval()
+
+    # The quantised kernels only run on the CPU
+    if cfg.quantize:
+        log.info("Quantising the linear layers of the network to INT8")
+        model.quantize_ema_network()
+    else:
+        model.to("cuda" if T.cuda.is_available() else "cpu")
+
+    # Start from a fresh file so that the appends do not mix runs
+    out_path = model_dir / "outputs" / f"{cfg.output_name}.h5"
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    log.info(f"Streaming {cfg.n_jets} generated jets to {out_path}")
+
+    n_done = 0
+    start = time.time()
+    with h5py.File(out_path, "w") as file:
+        for _, mask, high in cycle_loader(loader):
+            if n_done >= cfg.n_jets:
+                break
+
+            # Trim the final batch to exactly reach the requested number of jets
+            n_batch = min(len(mask), cfg.n_jets - n_done)
+            mask = mask[:n_batch].to(model.device)
+            high = high[:n_batch].to(model.device)
+
+            # Run the full sampler on this chunk only, nothing is kept in memory
+            with T.no_grad():
+                gen_nodes = model.full_generation(
+                    cfg.sampler_name,
+                    cfg.sampler_steps,
+                    mask=mask,
+                    ctxt=high,
+                    bucket_size=cfg.bucket_size,
+                    **cfg.sampler_kwargs,
+                )
+            gen_nodes, mask, high = to_np((gen_nodes, mask, high))
+
+            # Change the data from log(pt+1) into pt fraction (the jetnet format)
+            if log_squash_pt:
+                gen_nodes[..., -1] = undo_log_squash(gen_nodes[..., -1])
+                if high.shape[-1]:
+                    gen_nodes[..., -1] /= high[..., 0:1]
+                gen_nodes *= mask[..., None]
+
+            append_to_file(
+                file,
+                {"csts": gen_nodes.astype(np.float32), "mask": mask, "high": high},
+            )
+            n_done += n_batch
+
+            elapsed = time.time() - start
+            log.info(f"{n_done}/{cfg.n_jets} jets, {n_done / elapsed:.1f} jets/s")
+
+    elapsed = time.time() - start
+    log.info(
+        f"Generated {n_done} jets in {elapsed:.1f}s ({n_done / elapsed:.1f} jets/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+from typing import Iterator
+
+import numpy as np
+import torch as T
+from torch.utils.data import Sampler, default_collate
+
+
+class MultiplicityBucketSampler(Sampler):
+    """Batch sampler which groups jets with a similar number of constituents.
+
+    The jets are split into buckets using the multiplicity boundaries and every
+    batch is drawn from a single bucket. Combined with trim_collate this means
+    each batch is only padded up to its own longest jet.
+
+    The jets are shuffled within each bucket and the batches are shuffled across
+    buckets with a new seed every epoch, so each jet is seen once per epoch and
+    the bucket sizes set how often a batch comes from each bucket.
+    """
+
+    def __init__(
+        self,
+        multiplicity: np.ndarray,
+        batch_size: int,
+        boundaries: list,
+        shuffle: bool = True,
+        drop_last: bool = True,
+        seed: int = 0,
+    ) -> None:
+        """
+        Args:
+            multiplicity: The number of valid constituents in each jet
+            batch_size: The number of jets in each batch
+            boundaries: The multiplicities at which a new bucket starts
+            shuffle: If the jets and the batches are shuffled each epoch
+            drop_last: Drop the final incomplete batch of each bucket
+            seed: Combined with the epoch number to seed the shuffling
+        """
+        super().__init__()
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+        # The indices of all jets belonging to each non-empty bucket
+        bucket_ids = np.digitize(multiplicity, boundaries)
+        self.buckets = [np.flatnonzero(bucket_ids == i) for i in np.unique(bucket_ids)]
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch used to seed the shuffling of the next iteration."""
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[list]:
+        rng = np.random.default_rng((self.seed, self.epoch))
+        self.epoch += 1
+
+        # Split each (shuffled) bucket into batches
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = rng.permutation(bucket)
+            for i in range(0, len(bucket), self.batch_size):
+                batch = bucket[i : i + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch.tolist())
+
+        # Mix the batches of the different buckets
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        yield from batches
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return sum(len(b) // self.batch_size for b in self.buckets)
+        return sum(-(-len(b) // self.batch_size) for b in self.buckets)
+
+
+def trim_padding(sample: tuple) -> tuple:
+    """Remove the trailing nodes of a (csts, mask, high) batch which are padding
+    for every jet in the batch."""
+    csts, mask, high = sample
+    used_nodes = T.nonzero(mask.any(dim=0))
+    n_nodes = int(used_nodes[-1]) + 1 if len(used_nodes) else 1
+    return csts[:, :n_nodes], mask[:, :n_nodes], high
+
+
+def trim_collate(batch: list) -> tuple:
+    """Collate a list of (csts, mask, high) samples and trim the padding."""
+    return trim_padding(default_collate(batch))
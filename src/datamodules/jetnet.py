@@ -1,18 +1,41 @@
-from copy import deepcopy
-from typing import Mapping
+import hashlib
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Mapping, Optional, Union
 
 import numpy as np
+import torch as T
 from jetnet.datasets import JetNet
 from pytorch_lightning import LightningDataModule
 from torch.utils.data import DataLoader, Dataset
 
+from src.datamodules.bucketing import (
+    MultiplicityBucketSampler,
+    trim_collate,
+    trim_padding,
+)
+from src.datamodules.loaders import TensorBatchLoader
 from src.numpy_utils import log_squash
 from src.physics import numpy_locals_to_mass_and_pt
 
+log = logging.getLogger(__name__)
+
+# Increment when the preprocessing changes to invalidate the old caches
+CACHE_VERSION = 1
+CACHE_ARRAYS = ["csts", "mask", "high"]
+
 
 class JetNetData(Dataset):
     """Wrapper for the JetNet dataset so it works with our models with
-    different inputs."""
+    different inputs.
+
+    If a cache_dir is given the preprocessed arrays are saved there on the first
+    call and afterwards opened as memory maps. All processes using the same
+    config then share the same pages instead of each holding a copy.
+    """
 
     def __init__(self, **kwargs) -> None:
 
@@ -21,30 +44,72 @@ class JetNetData(Dataset):
         self.high_as_context = kwargs.pop("high_as_context", True)
         self.recalc_high = kwargs.pop("recalculate_jet_from_pc", True)
         self.n_jets = kwargs.pop("n_jets", None)
+        cache_dir = kwargs.pop("cache_dir", None)
 
-        # All other arguments passed to the jetnet dataset constructor
-        self.csts, self.high = JetNet.getData(**kwargs)
-        self.csts = self.csts.astype(np.float32)
-        self.high = self.high.astype(np.float32)
+        # All other arguments are passed to the jetnet dataset constructor
+        if cache_dir is None:
+            self.csts, self.mask, self.high = self._preprocess(**kwargs)
+        else:
+            self.csts, self.mask, self.high = self._load_cache(Path(cache_dir), kwargs)
+
+    def _preprocess(self, **kwargs) -> tuple:
+        """Load the jetnet data and return the processed csts, mask and high."""
+        csts, high = JetNet.getData(**kwargs)
 
         # Trim the data based on the requested number of jets (None does nothing)
-        self.csts = self.csts[: self.n_jets].astype(np.float32)
-        self.high = self.high[: self.n_jets].astype(np.float32)
+        csts = csts[: self.n_jets].astype(np.float32)
+        high = high[: self.n_jets].astype(np.float32)
 
         # Manually calculate the mask by looking for zero padding
-        self.mask = ~np.all(self.csts == 0, axis=-1)
+        mask = ~np.all(csts == 0, axis=-1)
 
         # Change the constituent information from pt-fraction to pure pt
-        csts = self.csts.copy()
-        csts[..., -1] = csts[..., -1] * self.high[..., 0:1]
+        pt_csts = csts.copy()
+        pt_csts[..., -1] = pt_csts[..., -1] * high[..., 0:1]
 
         # Recalculate the jet mass and pt using the point cloud
         if self.recalc_high:
-            self.high = numpy_locals_to_mass_and_pt(csts, self.mask)
+            high = numpy_locals_to_mass_and_pt(pt_csts, mask)
 
         # Change the pt fraction to log_squash(pt)
         if self.log_squash_pt:
-            self.csts[..., -1] = log_squash(csts[..., -1]) * self.mask
+            csts[..., -1] = log_squash(pt_csts[..., -1]) * mask
+
+        return csts, mask, high
+
+    def _load_cache(self, cache_dir: Path, kwargs: dict) -> tuple:
+        """Memory map the preprocessed arrays from the cache, filling it first
+        if this config has not been cached before."""
+
+        # Every argument which changes the arrays goes into the key
+        conf = {
+            "version": CACHE_VERSION,
+            "log_squash_pt": self.log_squash_pt,
+            "recalc_high": self.recalc_high,
+            "n_jets": self.n_jets,
+            **kwargs,
+        }
+        conf = json.dumps(conf, sort_keys=True, default=list)
+        path = cache_dir / hashlib.sha1(conf.encode()).hexdigest()
+
+        # Write to a temporary folder and rename, so readers never see a partial
+        # cache and concurrent jobs do not clash
+        if not path.exists():
+            log.info(f"Caching the preprocessed JetNet data to {path}")
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            tmp_path.mkdir(parents=True, exist_ok=True)
+            for name, arr in zip(CACHE_ARRAYS, self._preprocess(**kwargs)):
+                np.save(tmp_path / f"{name}.npy", arr)
+            (tmp_path / "config.json").write_text(conf)
+            try:
+                tmp_path.rename(path)
+            except OSError:  # Another process got there first
+                shutil.rmtree(tmp_path)
+
+        # Copy on write so the arrays can still be modified in memory
+        return tuple(
+            np.load(path / f"{name}.npy", mmap_mode="c") for name in CACHE_ARRAYS
+        )
 
     def __getitem__(self, idx) -> tuple:
         csts = self.csts[idx]
@@ -55,6 +120,12 @@ class JetNetData(Dataset):
     def __len__(self) -> int:
         return len(self.high)
 
+    def as_tensors(self) -> tuple:
+        """Return the full (csts, mask, high) dataset as torch tensors which
+        share memory with the arrays."""
+        high = self.high if self.high_as_context else np.empty((len(self), 0), "f")
+        return T.from_numpy(self.csts), T.from_numpy(self.mask), T.from_numpy(high)
+
 
 class JetNetDataModule(LightningDataModule):
     def __init__(
@@ -62,7 +133,19 @@ class JetNetDataModule(LightningDataModule):
         *,
         data_conf: Mapping,
         loader_kwargs: Mapping,
+        bucket_boundaries: Optional[list] = None,
+        loader_mode: str = "dataset",
     ) -> None:
+        """
+        Args:
+            data_conf: Keyword arguments for the JetNetData datasets
+            loader_kwargs: Keyword arguments for the dataloaders
+            bucket_boundaries: Multiplicities which split the training jets into
+                buckets, each batch is drawn from one bucket and trimmed to its
+                longest jet. None gives uniform shuffling with full padding.
+            loader_mode: Either "dataset" for a torch DataLoader with workers or
+                "tensor" to slice the batches directly from in-memory tensors
+        """
         super().__init__()
         self.save_hyperparameters(logger=False)
 
@@ -84,13 +167,61 @@ class JetNetDataModule(LightningDataModule):
         if stage == "test":
             self.test_set = JetNetData(**self.hparams.data_conf, split="test")
 
-    def train_dataloader(self) -> DataLoader:
-        return DataLoader(self.train_set, **self.hparams.loader_kwargs, shuffle=True)
-
-    def val_dataloader(self) -> DataLoader:
-        return DataLoader(self.valid_set, **self.hparams.loader_kwargs, shuffle=False)
-
-    def test_dataloader(self) -> DataLoader:
-        test_kwargs = deepcopy(self.hparams.loader_kwargs)
-        test_kwargs["drop_last"] = False
-        return DataLoader(self.test_set, **test_kwargs, shuffle=False)
+    def make_loader(
+        self,
+        dataset: JetNetData,
+        shuffle: bool,
+        batch_sampler: Optional[MultiplicityBucketSampler] = None,
+        **overrides,
+    ) -> Union[DataLoader, TensorBatchLoader]:
+        """Build the loader of the configured mode for one of the datasets."""
+        loader_kwargs = {**self.hparams.loader_kwargs, **overrides}
+
+        # The batch sampler takes over the batching arguments of the loader
+        collate_fn = None
+        if batch_sampler is not None:
+            loader_kwargs.pop("batch_size")
+            loader_kwargs.pop("drop_last", None)
+            shuffle = False
+
+        # Slicing tensors needs no workers, only the batching arguments are used
+        if self.hparams.loader_mode == "tensor":
+            return TensorBatchLoader(
+                dataset.as_tensors(),
+                batch_size=loader_kwargs.get("batch_size", 1),
+                shuffle=shuffle,
+                drop_last=loader_kwargs.get("drop_last", False),
+                batch_sampler=batch_sampler,
+                collate_fn=trim_padding if batch_sampler is not None else None,
+                pin_memory=loader_kwargs.get("pin_memory", False),
+                seed=T.initial_seed(),
+            )
+        if batch_sampler is not None:
+            collate_fn = trim_collate
+        return DataLoader(
+            dataset,
+            shuffle=shuffle,
+            batch_sampler=batch_sampler,
+            collate_fn=collate_fn,
+            **loader_kwargs,
+        )
+
+    def train_dataloader(self) -> Union[DataLoader, TensorBatchLoader]:
+        if self.hparams.bucket_boundaries is None:
+            return self.make_loader(self.train_set, shuffle=True)
+
+        # Batches are drawn from buckets of similar multiplicity
+        batch_sampler = MultiplicityBucketSampler(
+            self.train_set.mask.sum(axis=-1),
+            batch_size=self.hparams.loader_kwargs["batch_size"],
+            boundaries=list(self.hparams.bucket_boundaries),
+            drop_last=self.hparams.loader_kwargs.get("drop_last", False),
+            seed=T.initial_seed(),
+        )
+        return self.make_loader(self.train_set, False, batch_sampler=batch_sampler)
+
+    def val_dataloader(self) -> Union[DataLoader, TensorBatchLoader]:
+        return self.make_loader(self.valid_set, shuffle=False)
+
+    def test_dataloader(self) -> Union[DataLoader, TensorBatchLoader]:
+        return self.make_loader(self.test_set, shuffle=False, drop_last=False)
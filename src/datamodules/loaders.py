@@ -0,0 +1,87 @@
+from typing import Callable, Iterator, Optional
+
+import numpy as np
+import torch as T
+from torch.utils.data import Sampler
+
+
+class TensorBatchLoader:
+    """Iterates over batches taken directly from a tuple of in-memory tensors.
+
+    A lighter replacement for a DataLoader when the whole dataset is already a
+    set of arrays in memory. There are no per-item calls or worker processes.
+    Without a batch sampler the data is permuted once per epoch and every batch
+    is a view of a contiguous slice. With a batch sampler each batch is gathered
+    using its indices.
+    """
+
+    def __init__(
+        self,
+        tensors: tuple,
+        batch_size: int = 1,
+        shuffle: bool = False,
+        drop_last: bool = False,
+        batch_sampler: Optional[Sampler] = None,
+        collate_fn: Optional[Callable] = None,
+        pin_memory: bool = False,
+        seed: int = 0,
+    ) -> None:
+        """
+        Args:
+            tensors: The data, all with the same length on the first dimension
+            batch_size: The number of samples in each batch
+            shuffle: If the order of the samples is permuted each epoch
+            drop_last: Drop the final incomplete batch
+            batch_sampler: Yields the indices of each batch, overrides the above
+            collate_fn: Applied to the tuple of tensors of each batch
+            pin_memory: Keep the batches in page-locked memory, only with CUDA
+            seed: Combined with the epoch number to seed the shuffling
+        """
+        self.pin_memory = pin_memory and T.cuda.is_available()
+        self.tensors = tuple(t.pin_memory() if self.pin_memory else t for t in tensors)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.batch_sampler = batch_sampler
+        self.collate_fn = collate_fn
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch used to seed the shuffling of the next iteration."""
+        self.epoch = epoch
+        if hasattr(self.batch_sampler, "set_epoch"):
+            self.batch_sampler.set_epoch(epoch)
+
+    def _gather(self, idx: T.Tensor) -> tuple:
+        """Return the selected samples of every tensor."""
+        tensors = tuple(t[idx] for t in self.tensors)
+        if self.pin_memory:
+            tensors = tuple(t.pin_memory() for t in tensors)
+        return tensors
+
+    def __iter__(self) -> Iterator[tuple]:
+        collate_fn = self.collate_fn or (lambda x: x)
+
+        # Gather the indices given by the batch sampler
+        if self.batch_sampler is not None:
+            for idx in self.batch_sampler:
+                yield collate_fn(self._gather(T.as_tensor(idx)))
+            return
+
+        # Otherwise permute all data at once and slice contiguous views
+        tensors = self.tensors
+        if self.shuffle:
+            rng = np.random.default_rng((self.seed, self.epoch))
+            tensors = self._gather(T.from_numpy(rng.permutation(len(self.tensors[0]))))
+        self.epoch += 1
+        for i in range(len(self)):
+            start = i * self.batch_size
+            yield collate_fn(tuple(t[start : start + self.batch_size] for t in tensors))
+
+    def __len__(self) -> int:
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler)
+        if self.drop_last:
+            return len(self.tensors[0]) // self.batch_size
+        return -(-len(self.tensors[0]) // self.batch_size)
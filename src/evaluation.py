@@ -0,0 +1,154 @@
+"""Evaluation of the generated jets which can run outside of the training loop."""
+
+import multiprocessing as mp
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import partial
+from typing import Callable, Optional
+
+import numpy as np
+from jetnet.utils import efps
+
+from src.metrics import resolve_rng, w1efp, w1m, w1p
+from src.numpy_utils import undo_log_squash
+from src.plotting import marginal_histograms, plot_mpgan_marginals
+
+
+def prepare_for_metrics(
+    nodes: np.ndarray, high: np.ndarray, log_squash_pt: bool
+) -> np.ndarray:
+    """Change the nodes into the jetnet format (pt fraction) and clip them to
+    the expected jet spread."""
+
+    # Change the data from log(pt+1) into pt fraction (needed for metrics)
+    if log_squash_pt:
+        nodes[..., -1] = undo_log_squash(nodes[..., -1]) / high[..., 0:1]
+
+    # Apply clipping
+    nodes = np.nan_to_num(nodes)
+    nodes[..., 0] = np.clip(nodes[..., 0], -0.5, 0.5)
+    nodes[..., 1] = np.clip(nodes[..., 1], -0.5, 0.5)
+    nodes[..., 2] = np.clip(nodes[..., 2], 0, 1)
+    return nodes
+
+
+def compute_efps(
+    csts: np.ndarray, efp_jobs: int = 1, chunk_size: int = 5000
+) -> np.ndarray:
+    """Calculate the EFPs of a set of jets, split into chunks which are spread
+    over a pool of processes.
+
+    Our own pool is used instead of the one in energyflow as that can not be
+    started from inside another worker process.
+    """
+    if efp_jobs <= 1 or len(csts) <= chunk_size:
+        return efps(csts, efp_jobs=1)
+    chunks = np.array_split(csts, -(-len(csts) // chunk_size))
+    with ProcessPoolExecutor(efp_jobs, mp_context=mp.get_context("spawn")) as pool:
+        return np.vstack(list(pool.map(partial(efps, efp_jobs=1), chunks)))
+
+
+def jetnet_metrics(
+    gen_nodes: np.ndarray,
+    real_nodes: np.ndarray,
+    mask: np.ndarray,
+    current_epoch: int,
+    efp_jobs: int = 1,
+    reference: Optional[dict] = None,
+    rng: Optional[np.random.Generator] = None,
+) -> tuple:
+    """Calculate the Wasserstein metrics of the generated jets and plot the
+    MPGAN-like marginals.
+
+    The EFPs are calculated only once for each set of jets and shared between the
+    metric and the plots. The EFPs and histograms of the real jets are returned
+    as the reference, passing it back skips them when the real jets are fixed
+    (eg: the validation set without shuffling). The bootstrap draws from rng, or
+    from a generator seeded from the global numpy state if None.
+
+    Returns:
+        A dictionary of the metrics, a tuple of the constituent and jet images
+        and the reference features of the real jets
+    """
+    bootstrap = {
+        "num_eval_samples": 10000,
+        "num_batches": 10,
+        "rng": resolve_rng(rng),
+    }
+    w1m_val, w1m_err = w1m(real_nodes, gen_nodes, **bootstrap)
+    w1p_val, w1p_err = w1p(real_nodes, gen_nodes, **bootstrap)
+    gen_efps = compute_efps(gen_nodes, efp_jobs)
+
+    # The reference is only valid for the same real jets (eg: not the sanity check)
+    if reference is None or len(reference["efps"]) != len(real_nodes):
+        real_efps = compute_efps(real_nodes, efp_jobs)
+        reference = {
+            "efps": real_efps,
+            "hists": marginal_histograms(real_nodes, mask, real_efps),
+        }
+    w1efp_val, w1efp_err = w1efp(reference["efps"], gen_efps, **bootstrap)
+    metrics = {
+        "valid/w1m": w1m_val,
+        "valid/w1m_err": w1m_err,
+        "valid/w1p": w1p_val.mean(),
+        "valid/w1p_err": w1p_err.mean(),
+        "valid/w1efp": w1efp_val.mean(),
+        "valid/w1efp_err": w1efp_err.mean(),
+    }
+    images = plot_mpgan_marginals(
+        gen_nodes,
+        real_nodes,
+        mask,
+        current_epoch,
+        gen_efps,
+        node_hists=reference["hists"],
+    )
+    return {k: float(v) for k, v in metrics.items()}, images, reference
+
+
+class AsyncEvaluator:
+    """Runs evaluation functions in a pool of worker processes so that they do
+    not hold up the training loop.
+
+    With zero workers the functions are run immediately in this process, which
+    keeps the results available straight away (eg: for debugging).
+    """
+
+    def __init__(self, n_workers: int = 1) -> None:
+        self.n_workers = n_workers
+        self._pool = None
+        self._pending = []
+
+    def submit(self, step: int, fn: Callable, *args) -> None:
+        """Schedule a function to be evaluated, the step is returned with the
+        result so it can be logged against the correct point of training."""
+        if not self.n_workers:
+            future = Future()
+            future.set_result(fn(*args))
+        else:
+            # Spawned workers do not inherit the CUDA context of the trainer
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    self.n_workers, mp_context=mp.get_context("spawn")
+                )
+            future = self._pool.submit(fn, *args)
+        self._pending.append((step, future))
+
+    def collect(self, wait: bool = False) -> list:
+        """Return the (step, result) pairs of the finished evaluations in the
+        order they were submitted, optionally waiting for all to finish."""
+        done = []
+        while self._pending and (wait or self._pending[0][1].done()):
+            step, future = self._pending.pop(0)
+            done.append((step, future.result()))
+        return done
+
+    def shutdown(self) -> None:
+        """Stop the worker processes, unfinished evaluations are dropped."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        self._pending.clear()
+
+    def __getstate__(self) -> dict:
+        """The pool and results are not copied with the model."""
+        return {"n_workers": self.n_workers, "_pool": None, "_pending": []}
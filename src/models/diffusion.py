@@ -1,14 +1,67 @@
+import logging
 import math
-from typing import Optional, Tuple
+import weakref
+from functools import partial
+from typing import Callable, Optional, Tuple
 
 import torch as T
 from tqdm import tqdm
 
+log = logging.getLogger(__name__)
+
+# Butcher tableaus of embedded Runge-Kutta pairs used by the adaptive sampler
+# Each has the nodes c, the matrix a, the weights b of the propagated solution,
+# the weights b_low of the lower order embedded solution, and the lower order
+EMBEDDED_TABLEAUS = {
+    "heun_euler": {
+        "c": [0, 1],
+        "a": [[], [1]],
+        "b": [1 / 2, 1 / 2],
+        "b_low": [1, 0],
+        "order": 1,
+    },
+    "bosh3": {
+        "c": [0, 1 / 2, 3 / 4, 1],
+        "a": [[], [1 / 2], [0, 3 / 4], [2 / 9, 1 / 3, 4 / 9]],
+        "b": [2 / 9, 1 / 3, 4 / 9, 0],
+        "b_low": [7 / 24, 1 / 4, 1 / 3, 1 / 8],
+        "order": 2,
+    },
+    "dopri5": {
+        "c": [0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1, 1],
+        "a": [
+            [],
+            [1 / 5],
+            [3 / 40, 9 / 40],
+            [44 / 45, -56 / 15, 32 / 9],
+            [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+            [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+            [35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84],
+        ],
+        "b": [35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84, 0],
+        "b_low": [
+            5179 / 57600,
+            0,
+            7571 / 16695,
+            393 / 640,
+            -92097 / 339200,
+            187 / 2100,
+            1 / 40,
+        ],
+        "order": 4,
+    },
+}
+
+# Compiled sampler steps of each model for each (step function, batch size, number
+# of nodes), which are dropped together with the model
+_COMPILED_STEPS = weakref.WeakKeyDictionary()
+
 
 class VPDiffusionSchedule:
     def __init__(self, max_sr: float = 1, min_sr: float = 1e-2) -> None:
         self.max_sr = max_sr
         self.min_sr = min_sr
+        self._tables = {}
 
     def __call__(self, time: T.Tensor) -> T.Tensor:
         return cosine_diffusion_shedule(time, self.max_sr, self.min_sr)
@@ -16,6 +69,37 @@ class VPDiffusionSchedule:
     def get_betas(self, time: T.Tensor) -> T.Tensor:
         return cosine_beta_shedule(time, self.max_sr, self.min_sr)
 
+    def get_score_scales(self, time: T.Tensor) -> T.Tensor:
+        return cosine_score_scale(time, self.max_sr, self.min_sr)
+
+    def get_table(
+        self, n_steps: int, device: T.device, substeps: int = 1
+    ) -> Tuple[T.Tensor, T.Tensor, T.Tensor, T.Tensor, T.Tensor]:
+        """Return the schedule evaluated on the uniform solver grid from t=1 to
+        t=0.
+
+        The table is built once per (n_steps, substeps, device) and cached, so the
+        samplers only need to index into it during the loop.
+
+        Args:
+            n_steps: The number of steps taken by the solver
+            device: The device to hold the table on
+            substeps: The number of evaluations per step, eg: 2 for RK4 midpoints
+
+        Returns:
+            times, signal_rates, noise_rates, betas, score_scales
+            Each is 1D with length n_steps * substeps + 1
+            The score_scales are betas / noise_rates, which has a finite limit at t=0
+        """
+        key = (n_steps, substeps, str(device))
+        if key not in self._tables:
+            times = T.linspace(1, 0, n_steps * substeps + 1, device=device)
+            signal_rates, noise_rates = self(times)
+            betas = self.get_betas(times)
+            score_scales = self.get_score_scales(times)
+            self._tables[key] = (times, signal_rates, noise_rates, betas, score_scales)
+        return self._tables[key]
+
 
 def cosine_diffusion_shedule(
     diff_time: T.Tensor, max_sr: float = 1, min_sr: float = 1e-2
@@ -65,6 +149,20 @@ def cosine_beta_shedule(
     return 2 * (end_angle - start_angle) * T.tan(diffusion_angles)
 
 
+def cosine_score_scale(
+    diff_time: T.Tensor, max_sr: float = 1, min_sr: float = 1e-2
+) -> T.Tensor:
+    """Returns the ratio of the betas to the noise rates of the cosine schedule.
+
+    This is the factor which multiplies the predicted noise in the probability flow
+    ODE. Calculating it directly avoids the 0/0 at t=0 when max_sr=1.
+    """
+    start_angle = math.acos(max_sr)
+    end_angle = math.acos(min_sr)
+    diffusion_angles = start_angle + diff_time * (end_angle - start_angle)
+    return 2 * (end_angle - start_angle) / T.cos(diffusion_angles)
+
+
 def ddim_predict(
     noisy_data: T.Tensor,
     pred_noises: T.Tensor,
@@ -86,6 +184,7 @@ def ddim_sampler(
     mask: Optional[T.Tensor] = None,
     ctxt: Optional[T.BoolTensor] = None,
     clip_predictions: Optional[tuple] = None,
+    compile_step: bool = False,
 ) -> Tuple[T.Tensor, list]:
     """Apply the DDIM sampling process to generate a batch of samples from
     noise.
@@ -104,50 +203,68 @@ def ddim_sampler(
         mask: The mask for the output point clouds
         ctxt: The context tensor for the output point clouds
         clip_predictions: Can stabalise generation by clipping the outputs
+        compile_step: Run each step as a single compiled graph, see compiled_step
     """
 
-    # Get the initial noise for generation and the number of sammples
-    num_samples = initial_noise.shape[0]
-
-    # The shape needed for expanding the time encodings
-    expanded_shape = [-1] + [1] * (initial_noise.dim() - 1)
-
     # Check the input argument for the n_steps, must be less than what was trained
     all_stages = []
-    step_size = 1 / n_steps
+
+    # The schedule on the solver grid is only calculated once
+    table = diff_sched.get_table(n_steps, model.device)
+    step_fn = ddim_step
+    if compile_step:
+        step_fn, table = compiled_step(ddim_step, model, table, initial_noise)
 
     # The initial variables needed for the loop
     noisy_data = initial_noise
-    diff_times = T.ones(num_samples, device=model.device)
-    next_signal_rates, next_noise_rates = diff_sched(diff_times.view(expanded_shape))
     for step in tqdm(range(n_steps), "DDIM-sampling", leave=False):
 
-        # Update with the previous 'next' step
-        signal_rates = next_signal_rates
-        noise_rates = next_noise_rates
-
         # Keep track of the diffusion evolution
         if keep_all:
             all_stages.append(noisy_data)
 
-        # Apply the denoise step to get X_0 and expected noise
-        pred_noises = model(noisy_data, diff_times, mask, ctxt)
-        pred_data = ddim_predict(noisy_data, pred_noises, signal_rates, noise_rates)
-
-        # Get the next predicted components using the next signal and noise rates
-        diff_times = diff_times - step_size
-        next_signal_rates, next_noise_rates = diff_sched(
-            diff_times.view(expanded_shape)
+        # Apply the denoise step and remix to go from estimated X_0 -> X_{t-1}
+        noisy_data, pred_data = step_fn(
+            model,
+            noisy_data,
+            [x[step : step + 2] for x in table],
+            mask,
+            ctxt,
+            clip_predictions,
         )
 
-        # Clamp the predicted X_0 for stability
-        if clip_predictions is not None:
-            pred_data.clamp_(*clip_predictions)
+    return pred_data, all_stages
 
-        # Remix the predicted components to go from estimated X_0 -> X_{t-1}
-        noisy_data = next_signal_rates * pred_data + next_noise_rates * pred_noises
 
-    return pred_data, all_stages
+def ddim_step(
+    model,
+    noisy_data: T.Tensor,
+    table: list,
+    mask: Optional[T.BoolTensor] = None,
+    ctxt: Optional[T.Tensor] = None,
+    clip_predictions: Optional[tuple] = None,
+) -> Tuple[T.Tensor, T.Tensor]:
+    """A single DDIM step, the table holds the schedule (and the time encodings
+    if compiled) at the start and end of the step.
+
+    Returns:
+        The data at the end of the step and the predicted X_0
+    """
+    times, signal_rates, noise_rates, _, _, *encodings = table
+
+    # Apply the denoise step to get X_0 and expected noise
+    diff_times = times[0].expand(len(noisy_data))
+    time_encoding = encodings[0][0].expand(len(noisy_data), -1) if encodings else None
+    pred_noises = call_model(model, noisy_data, diff_times, mask, ctxt, time_encoding)
+    pred_data = ddim_predict(noisy_data, pred_noises, signal_rates[0], noise_rates[0])
+
+    # Clamp the predicted X_0 for stability
+    if clip_predictions is not None:
+        pred_data = pred_data.clamp(*clip_predictions)
+
+    # Remix the predicted components to go from estimated X_0 -> X_{t-1}
+    noisy_data = signal_rates[1] * pred_data + noise_rates[1] * pred_noises
+    return noisy_data, pred_data
 
 
 @T.no_grad()
@@ -167,30 +284,27 @@ def euler_maruyama_sampler(
     # Get the initial noise for generation and the number of sammples
     num_samples = initial_noise.shape[0]
 
-    # The shape needed for expanding the time encodings
-    expanded_shape = [-1] + [1] * (initial_noise.dim() - 1)
-
     # Check the input argument for the n_steps, must be less than what was trained
     all_stages = []
     delta_t = 1 / n_steps
 
+    # The schedule on the solver grid is only calculated once
+    times, _, noise_rates, betas, _ = diff_sched.get_table(n_steps, model.device)
+
     # The initial variables needed for the loop
     x_t = initial_noise
-    t = T.ones(num_samples, device=model.device)
     for step in tqdm(range(n_steps), "Euler-Maruyama-sampling", leave=False):
 
         # Use the model to get the expected noise
+        t = times[step].expand(num_samples)
         pred_noises = model(x_t, t, mask, ctxt)
 
         # Use to get s_theta
-        _, noise_rates = diff_sched(t.view(expanded_shape))
-        s = -pred_noises / noise_rates
+        s = -pred_noises / noise_rates[step]
 
         # Take one step using the em method
-        betas = diff_sched.get_betas(t.view(expanded_shape))
-        x_t += 0.5 * betas * (x_t + 2 * s) * delta_t
-        x_t += (betas * delta_t).sqrt() * T.randn_like(x_t)
-        t -= delta_t
+        x_t += 0.5 * betas[step] * (x_t + 2 * s) * delta_t
+        x_t += (betas[step] * delta_t).sqrt() * T.randn_like(x_t)
 
         # Keep track of the diffusion evolution
         if keep_all:
@@ -213,41 +327,76 @@ def euler_sampler(
     mask: Optional[T.Tensor] = None,
     ctxt: Optional[T.BoolTensor] = None,
     clip_predictions: Optional[tuple] = None,
+    compile_step: bool = False,
 ) -> Tuple[T.Tensor, list]:
     """Apply the full reverse process to noise to generate a batch of
-    samples."""
-
-    # Get the initial noise for generation and the number of sammples
-    num_samples = initial_noise.shape[0]
+    samples.
 
-    # The shape needed for expanding the time encodings
-    expanded_shape = [-1] + [1] * (initial_noise.dim() - 1)
+    With compile_step each step is run as a single compiled graph, see
+    compiled_step.
+    """
 
     # Check the input argument for the n_steps, must be less than what was trained
     all_stages = []
     delta_t = 1 / n_steps
 
+    # The schedule on the solver grid is only calculated once
+    table = diff_sched.get_table(n_steps, model.device)
+    step_fn = euler_step
+    if compile_step:
+        step_fn, table = compiled_step(euler_step, model, table, initial_noise)
+
     # The initial variables needed for the loop
-    t = T.ones(num_samples, device=model.device)
-    signal_rates, noise_rates = diff_sched(t.view(expanded_shape))
-    x_t = initial_noise * (signal_rates + noise_rates)
+    _, signal_rates, noise_rates, *_ = table
+    x_t = initial_noise * (signal_rates[0] + noise_rates[0])
     for step in tqdm(range(n_steps), "Euler-sampling", leave=False):
 
         # Take a step using the euler method and the gradient calculated by the ode
-        x_t += get_ode_gradient(model, diff_sched, x_t, t, mask, ctxt) * delta_t
-        t -= delta_t
+        x_t = step_fn(
+            model,
+            x_t,
+            [x[step : step + 2] for x in table],
+            delta_t,
+            mask,
+            ctxt,
+            clip_predictions,
+        )
 
         # Keep track of the diffusion evolution
         if keep_all:
             all_stages.append(x_t)
 
-        # Clamp the denoised data for stability
-        if clip_predictions is not None:
-            x_t.clamp_(*clip_predictions)
-
     return x_t, all_stages
 
 
+def euler_step(
+    model,
+    x_t: T.Tensor,
+    table: list,
+    delta_t: float,
+    mask: Optional[T.BoolTensor] = None,
+    ctxt: Optional[T.Tensor] = None,
+    clip_predictions: Optional[tuple] = None,
+) -> T.Tensor:
+    """A single step of the euler method on the probability flow ODE, the
+    table holds the schedule (and the time encodings if compiled) at the start
+    and end of the step."""
+    times, _, _, betas, score_scales, *encodings = table
+
+    # The schedule is taken from the table so the diffusion scheduler is not needed
+    t = times[0].expand(len(x_t))
+    time_encoding = encodings[0][0].expand(len(x_t), -1) if encodings else None
+    grad = get_ode_gradient(
+        model, None, x_t, t, mask, ctxt, betas[0], score_scales[0], time_encoding
+    )
+    x_t = x_t + grad * delta_t
+
+    # Clamp the denoised data for stability
+    if clip_predictions is not None:
+        x_t = x_t.clamp(*clip_predictions)
+    return x_t
+
+
 @T.no_grad()
 def runge_kutta_sampler(
     model,
@@ -258,32 +407,239 @@ def runge_kutta_sampler(
     mask: Optional[T.Tensor] = None,
     ctxt: Optional[T.BoolTensor] = None,
     clip_predictions: Optional[tuple] = None,
+    compile_step: bool = False,
 ) -> Tuple[T.Tensor, list]:
     """Apply the full reverse process to noise to generate a batch of
-    samples."""
+    samples.
 
-    # Get the initial noise for generation and the number of sammples
-    num_samples = initial_noise.shape[0]
+    With compile_step each step is run as a single compiled graph, see
+    compiled_step.
+    """
 
     # Check the input argument for the n_steps, must be less than what was trained
     all_stages = []
     delta_t = 1 / n_steps
 
-    # Wrap the ode gradient in a lambda function depending only on xt and t
-    ode_grad = lambda t, x_t: get_ode_gradient(model, diff_sched, x_t, t, mask, ctxt)
+    # The schedule is needed at the start, midpoint, and end of each step
+    table = diff_sched.get_table(n_steps, model.device, substeps=2)
+    step_fn = runge_kutta_step
+    if compile_step:
+        step_fn, table = compiled_step(runge_kutta_step, model, table, initial_noise)
 
     # The initial variables needed for the loop
     x_t = initial_noise
-    t = T.ones(num_samples, device=model.device)
     for step in tqdm(range(n_steps), "Runge-Kutta-sampling", leave=False):
 
-        k1 = delta_t * (ode_grad(t, x_t))
-        k2 = delta_t * (ode_grad((t - delta_t / 2), (x_t + k1 / 2)))
-        k3 = delta_t * (ode_grad((t - delta_t / 2), (x_t + k2 / 2)))
-        k4 = delta_t * (ode_grad((T.clamp_min(t - delta_t, 0)), (x_t + k3)))
-        k = (k1 + 2 * k2 + 2 * k3 + k4) / 6
-        x_t += k
-        t -= delta_t
+        # Take a step using the fourth order method
+        x_t = step_fn(
+            model,
+            x_t,
+            [x[2 * step : 2 * step + 3] for x in table],
+            delta_t,
+            mask,
+            ctxt,
+            clip_predictions,
+        )
+
+        # Keep track of the diffusion evolution
+        if keep_all:
+            all_stages.append(x_t)
+
+    return x_t, all_stages
+
+
+def runge_kutta_step(
+    model,
+    x_t: T.Tensor,
+    table: list,
+    delta_t: float,
+    mask: Optional[T.BoolTensor] = None,
+    ctxt: Optional[T.Tensor] = None,
+    clip_predictions: Optional[tuple] = None,
+) -> T.Tensor:
+    """A single step of the fourth order Runge-Kutta method on the probability
+    flow ODE, the table holds the schedule (and the time encodings if compiled)
+    at the start, midpoint and end of the step."""
+    times, _, _, betas, score_scales, *encodings = table
+
+    # Wrap the ode gradient in a lambda function depending only on xt and the index
+    ode_grad = lambda i, x_t: get_ode_gradient(
+        model,
+        None,
+        x_t,
+        times[i].expand(len(x_t)),
+        mask,
+        ctxt,
+        betas=betas[i],
+        score_scales=score_scales[i],
+        time_encoding=encodings[0][i].expand(len(x_t), -1) if encodings else None,
+    )
+
+    k1 = delta_t * (ode_grad(0, x_t))
+    k2 = delta_t * (ode_grad(1, (x_t + k1 / 2)))
+    k3 = delta_t * (ode_grad(1, (x_t + k2 / 2)))
+    k4 = delta_t * (ode_grad(2, (x_t + k3)))
+    k = (k1 + 2 * k2 + 2 * k3 + k4) / 6
+    x_t = x_t + k
+
+    # Clamp the denoised data for stability
+    if clip_predictions is not None:
+        x_t = x_t.clamp(*clip_predictions)
+    return x_t
+
+
+@T.no_grad()
+def dpm_solver_sampler(
+    model,
+    diff_sched: VPDiffusionSchedule,
+    initial_noise: T.Tensor,
+    n_steps: int = 20,
+    keep_all: bool = False,
+    mask: Optional[T.Tensor] = None,
+    ctxt: Optional[T.BoolTensor] = None,
+    clip_predictions: Optional[tuple] = None,
+    order: int = 2,
+) -> Tuple[T.Tensor, list]:
+    """Apply the multistep DPM-Solver++ (2M or 3M) to generate a batch of
+    samples, as proposed in https://arxiv.org/abs/2211.01095
+
+    The network is called once per step and the data predictions of the previous
+    steps are reused to build a higher order update in log-SNR.
+    The first steps (not enough history) and the final step (infinite log-SNR at
+    t=0) fall back to lower orders.
+
+    Args:
+        model: A denoising diffusion model
+        diif_sched: A diffusion schedule object to calculate signal and noise rates
+        initial_noise: The initial noise to pass through the process
+        n_steps: The number of iterations, equal to the number of network calls
+        keep_all: Return all stages of diffusion process
+        mask: The mask for the output point clouds
+        ctxt: The context tensor for the output point clouds
+        clip_predictions: Can stabalise generation by clipping the predicted X_0
+        order: The order of the multistep solver, either 1, 2 or 3
+    """
+
+    # Check the order of the solver
+    if order not in [1, 2, 3]:
+        raise ValueError(f"DPM-Solver++ only supports orders 1, 2 or 3, not {order}")
+
+    # The diffusion time of each step is broadcast over the whole batch
+    num_samples = initial_noise.shape[0]
+
+    # The intermediate solutions, only filled if keep_all
+    all_stages = []
+
+    # The schedule and the log signal to noise ratios on the solver grid
+    times, signal_rates, noise_rates, _, _ = diff_sched.get_table(n_steps, model.device)
+    lambdas = T.log(signal_rates) - T.log(noise_rates)
+
+    # The initial variables needed for the loop
+    x_t = initial_noise
+    pred_hist = []  # Previous data predictions, most recent first
+    for step in tqdm(range(n_steps), f"DPM-Solver++({order}M)-sampling", leave=False):
+
+        # Keep track of the diffusion evolution
+        if keep_all:
+            all_stages.append(x_t)
+
+        # Use the model to get the predicted X_0
+        t = times[step].expand(num_samples)
+        pred_noises = model(x_t, t, mask, ctxt)
+        pred_data = ddim_predict(
+            x_t, pred_noises, signal_rates[step], noise_rates[step]
+        )
+
+        # Clamp the predicted X_0 for stability
+        if clip_predictions is not None:
+            pred_data.clamp_(*clip_predictions)
+        pred_hist = [pred_data] + pred_hist[: order - 1]
+
+        # The step in log-SNR and the exponential integrator term
+        h = lambdas[step + 1] - lambdas[step]
+        phi = T.expm1(-h)
+        step_order = min(order, len(pred_hist), n_steps - step)
+
+        # The linear part plus the first order term
+        alpha = signal_rates[step + 1]
+        x_t = (
+            noise_rates[step + 1] / noise_rates[step]
+        ) * x_t - alpha * phi * pred_data
+
+        # Second order correction using the previous prediction
+        if step_order == 2:
+            r0 = (lambdas[step] - lambdas[step - 1]) / h
+            d1 = (pred_hist[0] - pred_hist[1]) / r0
+            x_t = x_t - 0.5 * alpha * phi * d1
+
+        # Third order correction using the two previous predictions
+        elif step_order == 3:
+            r0 = (lambdas[step] - lambdas[step - 1]) / h
+            r1 = (lambdas[step - 1] - lambdas[step - 2]) / h
+            d1_0 = (pred_hist[0] - pred_hist[1]) / r0
+            d1_1 = (pred_hist[1] - pred_hist[2]) / r1
+            d1 = d1_0 + (r0 / (r0 + r1)) * (d1_0 - d1_1)
+            d2 = (d1_0 - d1_1) / (r0 + r1)
+            x_t = x_t + alpha * (phi / h + 1) * d1
+            x_t = x_t - alpha * ((phi + h) / h**2 - 0.5) * d2
+
+    return x_t, all_stages
+
+
+@T.no_grad()
+def linear_multistep_sampler(
+    model,
+    diff_sched: VPDiffusionSchedule,
+    initial_noise: T.Tensor,
+    n_steps: int = 20,
+    keep_all: bool = False,
+    mask: Optional[T.Tensor] = None,
+    ctxt: Optional[T.BoolTensor] = None,
+    clip_predictions: Optional[tuple] = None,
+    order: int = 4,
+) -> Tuple[T.Tensor, list]:
+    """Apply the Adams-Bashforth linear multistep method to the probability
+    flow ODE.
+
+    Each step calls the network once and combines the ODE gradients of up to
+    the last 'order' steps, the first steps use the lower orders.
+    """
+
+    # The Adams-Bashforth weights for the gradients, most recent first
+    ab_weights = {
+        1: [1],
+        2: [3 / 2, -1 / 2],
+        3: [23 / 12, -16 / 12, 5 / 12],
+        4: [55 / 24, -59 / 24, 37 / 24, -9 / 24],
+    }
+    if order not in ab_weights:
+        raise ValueError(f"Linear multistep only supports orders 1 to 4, not {order}")
+
+    # The diffusion time of each step is broadcast over the whole batch
+    num_samples = initial_noise.shape[0]
+
+    # The intermediate solutions (only filled if keep_all) and the fixed step size
+    all_stages = []
+    delta_t = 1 / n_steps
+
+    # The schedule on the solver grid is only calculated once
+    times, _, _, betas, score_scales = diff_sched.get_table(n_steps, model.device)
+
+    # The initial variables needed for the loop
+    x_t = initial_noise
+    grad_hist = []  # Previous gradients, most recent first
+    for step in tqdm(range(n_steps), "Linear-multistep-sampling", leave=False):
+
+        # Get the gradient of the ODE and add it to the history
+        t = times[step].expand(num_samples)
+        grad = get_ode_gradient(
+            model, diff_sched, x_t, t, mask, ctxt, betas[step], score_scales[step]
+        )
+        grad_hist = [grad] + grad_hist[: order - 1]
+
+        # Take a step using the weighted sum of the stored gradients
+        weights = ab_weights[len(grad_hist)]
+        x_t = x_t + delta_t * sum(w * g for w, g in zip(weights, grad_hist))
 
         # Keep track of the diffusion evolution
         if keep_all:
@@ -296,6 +652,159 @@ def runge_kutta_sampler(
     return x_t, all_stages
 
 
+@T.no_grad()
+def adaptive_sampler(
+    model,
+    diff_sched: VPDiffusionSchedule,
+    initial_noise: T.Tensor,
+    n_steps: int = 50,
+    keep_all: bool = False,
+    mask: Optional[T.Tensor] = None,
+    ctxt: Optional[T.BoolTensor] = None,
+    clip_predictions: Optional[tuple] = None,
+    method: str = "dopri5",
+    rtol: float = 1e-3,
+    atol: float = 1e-3,
+    max_steps: int = 1000,
+) -> Tuple[T.Tensor, list]:
+    """Solve the probability flow ODE using an embedded Runge-Kutta pair, which
+    adapts the step size to keep the estimated local error within tolerance.
+
+    The step size is shared by the whole batch and the error is the RMS over all
+    valid elements, so the number of network calls depends on the smoothness of
+    the trajectories rather than a fixed grid.
+    The number of function evaluations (NFE) is logged at the end.
+
+    Args:
+        model: A denoising diffusion model
+        diif_sched: A diffusion schedule object to calculate signal and noise rates
+        initial_noise: The initial noise to pass through the process
+        n_steps: Only sets the size of the first attempted step as 1/n_steps
+        keep_all: Return all stages of diffusion process (accepted steps only)
+        mask: The mask for the output point clouds
+        ctxt: The context tensor for the output point clouds
+        clip_predictions: Can stabalise generation by clipping the outputs
+        method: The name of the embedded pair in EMBEDDED_TABLEAUS
+        rtol: The relative tolerance on the local error
+        atol: The absolute tolerance on the local error
+        max_steps: Maximum number of adaptive steps (accepted or rejected), the
+            rest of the process is then completed with fixed steps of 1/n_steps
+    """
+
+    # Load the tableau of the requested method
+    if method not in EMBEDDED_TABLEAUS:
+        raise ValueError(f"Unknown adaptive method: {method}")
+    tableau = EMBEDDED_TABLEAUS[method]
+    c, a, b, b_low = tableau["c"], tableau["a"], tableau["b"], tableau["b_low"]
+    err_exp = -1 / (tableau["order"] + 1)
+
+    # First same as last: the final stage is the first stage of the next step
+    fsal = c[-1] == 1 and a[-1] == b[:-1] and b[-1] == 0
+
+    # Each gradient is evaluated at a single time shared by the whole batch
+    num_samples = initial_noise.shape[0]
+
+    # The gradient function, the schedule is calculated for a single time
+    def ode_grad(t: float, x_t: T.Tensor) -> T.Tensor:
+        time = T.full((num_samples,), t, device=model.device)
+        return get_ode_gradient(
+            model,
+            diff_sched,
+            x_t,
+            time,
+            mask,
+            ctxt,
+            betas=diff_sched.get_betas(time[0]),
+            score_scales=diff_sched.get_score_scales(time[0]),
+        )
+
+    # The initial variables needed for the loop, like the other samplers the
+    # gradient is with respect to reversed time, so h > 0 while t decreases
+    all_stages = []
+    x_t = initial_noise
+    t = 1.0
+    h = 1 / n_steps
+    k_first = None
+    nfe = n_accepted = n_rejected = n_fixed = 0
+    fixed_h = None
+    pbar = tqdm(desc="Adaptive-sampling", leave=False)
+    while t > 0:
+
+        # If the solver is stuck then finish the process without error control
+        if fixed_h is None and n_accepted + n_rejected >= max_steps:
+            fixed_h = 1 / n_steps
+            log.warning(
+                f"Adaptive sampler hit max_steps={max_steps} at t={t:.4f}, "
+                f"finishing with fixed steps of {fixed_h:.4f}"
+            )
+        if fixed_h is not None:
+            h = fixed_h
+
+        # Do not step past the end of the diffusion process
+        h = min(h, t)
+
+        # Calculate each stage, reusing the final stage of the last step if possible
+        ks = []
+        for i in range(len(c)):
+            if i == 0 and k_first is not None:
+                ks.append(k_first)
+                continue
+            x_stage = x_t
+            for a_ij, k_j in zip(a[i], ks):
+                if a_ij:
+                    x_stage = x_stage + h * a_ij * k_j
+            ks.append(ode_grad(max(t - c[i] * h, 0.0), x_stage))
+            nfe += 1
+
+        # The propagated solution and the error estimate
+        x_new = x_t + h * sum(b_i * k_i for b_i, k_i in zip(b, ks) if b_i)
+        x_err = h * sum((b_i - bl_i) * k_i for b_i, bl_i, k_i in zip(b, b_low, ks))
+
+        # The mixed absolute/relative RMS error over the valid elements
+        scale = atol + rtol * T.maximum(x_t.abs(), x_new.abs())
+        ratio = x_err / scale
+        if mask is not None:
+            ratio = ratio[mask]
+        error = ratio.square().mean().sqrt().item()
+
+        # Accept the step if within the tolerance (or if the steps are fixed)
+        if error <= 1 or fixed_h is not None:
+            x_t = x_new
+            t = t - h
+            k_first = ks[-1] if fsal else None
+            if fixed_h is None:
+                n_accepted += 1
+            else:
+                n_fixed += 1
+
+            # Keep track of the diffusion evolution
+            if keep_all:
+                all_stages.append(x_t)
+
+            # Clamp the denoised data for stability, this invalidates the last stage
+            if clip_predictions is not None:
+                low, high = clip_predictions
+                if ((x_t < low) | (x_t > high)).any():
+                    x_t.clamp_(low, high)
+                    k_first = None
+        else:
+            n_rejected += 1
+
+        # Update the step size using the standard controller with a safety factor
+        factor = 5.0 if error == 0 else min(5.0, max(0.2, 0.9 * error**err_exp))
+        h = h * factor
+        pbar.update()
+        pbar.set_postfix(t=t, nfe=nfe)
+    pbar.close()
+
+    log.info(
+        f"Adaptive sampler ({method}) used {nfe} function evaluations: "
+        f"{n_accepted} accepted, {n_rejected} rejected and {n_fixed} fixed steps"
+    )
+
+    return x_t, all_stages
+
+
 def get_ode_gradient(
     model,
     diff_sched: VPDiffusionSchedule,
@@ -303,11 +812,71 @@ def get_ode_gradient(
     t: T.Tensor,
     mask: Optional[T.BoolTensor] = None,
     ctxt: Optional[T.Tensor] = None,
+    betas: Optional[T.Tensor] = None,
+    score_scales: Optional[T.Tensor] = None,
+    time_encoding: Optional[T.Tensor] = None,
+) -> T.Tensor:
+    """Calculate the gradient of the probability flow ODE at time t.
+
+    The betas and score_scales (betas / noise_rates) can be passed from a
+    precomputed table, otherwise they are derived per sample from t.
+    """
+    pred_noises = call_model(model, x_t, t, mask, ctxt, time_encoding)
+    if betas is None or score_scales is None:
+        expanded_shape = [-1] + [1] * (x_t.dim() - 1)
+        _, noise_rates = diff_sched(t.view(expanded_shape))
+        betas = diff_sched.get_betas(t.view(expanded_shape))
+        return 0.5 * betas * (x_t - pred_noises / noise_rates)
+    return 0.5 * (betas * x_t - score_scales * pred_noises)
+
+
+def call_model(
+    model,
+    x_t: T.Tensor,
+    t: T.Tensor,
+    mask: Optional[T.BoolTensor] = None,
+    ctxt: Optional[T.Tensor] = None,
+    time_encoding: Optional[T.Tensor] = None,
 ) -> T.Tensor:
-    expanded_shape = [-1] + [1] * (x_t.dim() - 1)
-    _, noise_rates = diff_sched(t.view(expanded_shape))
-    betas = diff_sched.get_betas(t.view(expanded_shape))
-    return 0.5 * betas * (x_t - model(x_t, t, mask, ctxt) / noise_rates)
+    """Estimate the noise with the model, the encoding of the times is only
+    passed if it was precalculated so models without it also work."""
+    if time_encoding is None:
+        return model(x_t, t, mask, ctxt)
+    return model(x_t, t, mask, ctxt, time_encoding=time_encoding)
+
+
+def compiled_step(
+    step_fn: Callable, model, table: tuple, x_t: T.Tensor
+) -> Tuple[Callable, tuple]:
+    """Return the step function of a sampler compiled with torch.compile and
+    the table extended with the time encoding of each grid point.
+
+    The network call, the schedule and the update of each step are captured as a
+    single graph with static shapes, so there is one graph for each batch size
+    and number of nodes. These are cached for the life of the model, only the
+    first call with a new shape pays for the compilation.
+
+    The time encoding is calculated eagerly, as its highest frequencies are
+    beyond float32 resolution and any reordering of the compiled operations
+    gives the network different inputs to those it was trained with.
+    """
+    table = (*table, model.time_encoder(table[0]))
+    model_steps = _COMPILED_STEPS.setdefault(model, {})
+    key = (step_fn.__name__, *x_t.shape[:-1])
+    if key not in model_steps:
+        log.info(f"Compiling {step_fn.__name__} for point clouds of {x_t.shape}")
+        model_steps[key] = T.compile(step_fn, dynamic=False)
+
+    # Every model and shape is a new graph of the same code, which dynamo limits
+    n_graphs = sum(len(steps) for steps in _COMPILED_STEPS.values())
+    cache_size_limit = max(T._dynamo.config.cache_size_limit, n_graphs)
+    return partial(_run_compiled, model_steps[key], cache_size_limit), table
+
+
+def _run_compiled(compiled_fn: Callable, cache_size_limit: int, *args) -> tuple:
+    """Call a compiled step with the dynamo cache limit raised only for the call."""
+    with T._dynamo.config.patch(cache_size_limit=cache_size_limit):
+        return compiled_fn(*args)
 
 
 def run_sampler(sampler: str, *args, **kwargs) -> Tuple[T.Tensor, list]:
@@ -319,4 +888,14 @@ def run_sampler(sampler: str, *args, **kwargs) -> Tuple[T.Tensor, list]:
         return runge_kutta_sampler(*args, **kwargs)
     if sampler == "ddim":
         return ddim_sampler(*args, **kwargs)
+    if sampler == "distilled":  # The students of progressive distillation
+        return ddim_sampler(*args, **kwargs)
+    if sampler == "adaptive":
+        return adaptive_sampler(*args, **kwargs)
+    if sampler == "dpm2m":
+        return dpm_solver_sampler(*args, order=2, **kwargs)
+    if sampler == "dpm3m":
+        return dpm_solver_sampler(*args, order=3, **kwargs)
+    if sampler == "lms":
+        return linear_multistep_sampler(*args, **kwargs)
     raise RuntimeError(f"Unknown sampler: {sampler}")
@@ -1,10 +1,11 @@
 """Collection of pytorch modules that make up the networks."""
 
 import math
-from typing import Optional, Union
+from typing import Iterable, Optional, Union
 
 import torch as T
 import torch.nn as nn
+from torch.nn.functional import linear
 
 
 def get_act(name: str) -> nn.Module:
@@ -30,6 +31,15 @@ def get_act(name: str) -> nn.Module:
     raise ValueError("No activation function with name: ", name)
 
 
+def linear_params(layer: nn.Module) -> tuple:
+    """Return the float weight and bias of a linear layer, for dynamically
+    quantised layers these are methods which give the dequantised values."""
+    weight, bias = layer.weight, layer.bias
+    if callable(weight):
+        weight, bias = weight().dequantize(), bias()
+    return weight, bias
+
+
 def get_nrm(name: str, outp_dim: int) -> nn.Module:
     """Return a 1D pytorch normalisation layer given a name and a output size
     Returns None object if name is none."""
@@ -114,22 +124,81 @@ class MLPBlock(nn.Module):
             if drp > 0:
                 self.block.append(nn.Dropout(drp))
 
-    def forward(self, inpt: T.Tensor, ctxt: Optional[T.Tensor] = None) -> T.Tensor:
+        # Seperate layer for the context, only once split_context_layer is called
+        self.ctxt_linear = None
+
+    def split_context_layer(self) -> None:
+        """Split the first linear layer into one for the input and one (without
+        bias) for the context, eg: so that each is quantised with its own range.
+
+        The context is then always projected before being broadcast.
+        """
+        if not self.ctxt_dim or self.ctxt_linear is not None:
+            return
+        first = self.block[0]
+        inpt_linear = nn.Linear(self.inpt_dim, self.outp_dim).to(first.weight)
+        ctxt_linear = nn.Linear(self.ctxt_dim, self.outp_dim, bias=False)
+        ctxt_linear = ctxt_linear.to(first.weight)
+        with T.no_grad():
+            inpt_linear.weight.copy_(first.weight[:, : self.inpt_dim])
+            inpt_linear.bias.copy_(first.bias)
+            ctxt_linear.weight.copy_(first.weight[:, self.inpt_dim :])
+        self.block[0] = inpt_linear
+        self.ctxt_linear = ctxt_linear
+
+    def static_projection(self, static: T.Tensor) -> T.Tensor:
+        """Project the trailing features of the block input through the first
+        linear layer (with its bias) so the result can be reused.
+
+        args:
+            static: The final features of the input, which do not change between calls
+        """
+        weight, bias = linear_params(self.block[0])
+        return linear(static, weight[:, -static.shape[-1] :], bias)
+
+    def forward(
+        self,
+        inpt: T.Tensor,
+        ctxt: Optional[T.Tensor] = None,
+        static_proj: Optional[T.Tensor] = None,
+    ) -> T.Tensor:
         """
         args:
             tensor: Pytorch tensor to pass through the network
             ctxt: The conditioning tensor, can be ignored
+            static_proj: Output of static_projection for the missing trailing inputs
         """
 
-        # Concatenate the context information to the input of the block
+        # Check the context information for the input of the block
         if self.ctxt_dim and ctxt is None:
             raise ValueError(
                 "Was expecting contextual information but none has been provided!"
             )
-        temp = T.cat([inpt, ctxt], dim=-1) if self.ctxt_dim else inpt
+        if static_proj is not None and (self.ctxt_dim or self.do_res):
+            raise ValueError("Static projections only work without context or res!")
+        first = self.block[0]
+
+        # The first layer only needs to process the leading (changing) features
+        if static_proj is not None:
+            weight, _ = linear_params(first)
+            temp = linear(inpt, weight[:, : inpt.shape[-1]]) + static_proj
+
+        # The context has its own layer once split
+        elif self.ctxt_linear is not None:
+            temp = first(inpt) + self.ctxt_linear(ctxt)
+
+        # Context shared over the extra dims (eg: nodes) is projected only once
+        elif self.ctxt_dim and ctxt.shape[:-1] != inpt.shape[:-1]:
+            weight, bias = linear_params(first)
+            temp = linear(inpt, weight[:, : self.inpt_dim], bias)
+            temp = temp + linear(ctxt, weight[:, self.inpt_dim :])
+
+        # Otherwise concatenate the context information to the input of the block
+        else:
+            temp = first(T.cat([inpt, ctxt], dim=-1) if self.ctxt_dim else inpt)
 
-        # Pass through each transform in the block
-        for layer in self.block:
+        # Pass through the remaining transforms in the block
+        for layer in self.block[1:]:
             temp = layer(temp)
 
         # Add the original inputs again for the residual connection
@@ -274,18 +343,31 @@ class DenseNetwork(nn.Module):
                 act=act_o,
             )
 
-    def forward(self, inputs: T.Tensor, ctxt: Optional[T.Tensor] = None) -> T.Tensor:
-        """Pass through all layers of the dense network."""
+    def static_projection(self, static: T.Tensor) -> T.Tensor:
+        """Precompute the contribution of the trailing input features to the
+        first layer, see MLPBlock.static_projection."""
+        return self.input_block.static_projection(static)
+
+    def forward(
+        self,
+        inputs: T.Tensor,
+        ctxt: Optional[T.Tensor] = None,
+        static_proj: Optional[T.Tensor] = None,
+    ) -> T.Tensor:
+        """Pass through all layers of the dense network.
+
+        If static_proj is provided then the inputs are only the leading features
+        and the remaining ones have been precomputed using static_projection.
+        """
 
-        # Reshape the context if it is available
+        # Reshape the context if it is available, it is broadcast in each block
         if ctxt is not None:
             dim_diff = inputs.dim() - ctxt.dim()
             if dim_diff > 0:
                 ctxt = ctxt.view(ctxt.shape[0], *dim_diff * (1,), *ctxt.shape[1:])
-                ctxt = ctxt.expand(*inputs.shape[:-1], -1)
 
         # Pass through the input block
-        inputs = self.input_block(inputs, ctxt)
+        inputs = self.input_block(inputs, ctxt, static_proj)
 
         # Pass through each hidden block
         for h_block in self.hidden_blocks:  # Context tensor will only be used if
@@ -432,35 +514,76 @@ class IterativeNormLayer(nn.Module):
         self.m2 = self.vars * self.n
         self.frozen = freeze
 
+    def _where(self, mapped: T.Tensor, inpt: T.Tensor, mask: T.BoolTensor) -> T.Tensor:
+        """Take the mapped values for the masked elements and leave the rest,
+        this avoids the data dependant shapes (and syncs) of boolean indexing."""
+        mask = mask.view(*mask.shape, *(inpt.dim() - mask.dim()) * [1])
+        return T.where(mask, mapped, inpt)
+
+    def fit_stream(self, batches: Iterable, freeze: bool = True) -> None:
+        """Set the exact stats from a stream of (inpt, mask) batches.
+
+        The batches are combined using the parallel form of the welford algorithm
+        in double precision, so only one batch is held in memory at a time.
+        """
+        dims = (0, *self.extra_dims)
+        n_rows = 0
+        count = 0
+        means = m2 = T.zeros(self.stat_dim, dtype=T.float64, device=self.means.device)
+        for inpt, mask in batches:
+            inpt = inpt.to(self.means.device, T.float64)
+            if mask is not None:
+                inpt = inpt[mask.to(self.means.device)]
+            if not len(inpt):
+                continue
+
+            # Merge the stats of this batch into the running ones
+            batch_vars, batch_means = T.var_mean(
+                inpt, dim=dims, keepdim=True, correction=0
+            )
+            batch_count = inpt.numel() // batch_means.numel()
+            delta = batch_means - means
+            total = count + batch_count
+            means = means + delta * batch_count / total
+            m2 = (
+                m2 + batch_vars * batch_count + delta**2 * count * batch_count / total
+            )
+            count = total
+            n_rows += len(inpt)
+
+        if not n_rows:
+            raise ValueError("No valid inputs were provided to fit the stats")
+
+        # Cast back to the precision of the layer, with the unbiased variance as fit
+        self.means = means.to(self.m2.dtype)
+        self.vars = (m2 / (count - 1)).to(self.m2.dtype)
+        self.n = T.tensor(n_rows, device=self.means.device)
+        self.m2 = self.vars * self.n
+        self.frozen = freeze
+
     def forward(self, inpt: T.Tensor, mask: Optional[T.BoolTensor] = None) -> T.Tensor:
         """Applies the standardisation to a batch of inputs, also uses the
         inputs to update the running stats if in training mode."""
         with T.no_grad():
-            sel_inpt = self._mask(inpt, mask)
             if not self.frozen and self.training:
-                self.update(sel_inpt)
+                self.update(inpt, mask)
 
             # Apply the mapping
-            normed_inpt = (sel_inpt - self.means) / (self.vars.sqrt() + 1e-8)
+            normed_inpt = (inpt - self.means) / (self.vars.sqrt() + 1e-8)
 
-            # Undo the masking
+            # Leave the padded elements untouched
             if mask is not None:
-                inpt = inpt.clone()  # prevents inplace operation, bad for autograd
-                inpt[mask] = normed_inpt
-                return inpt
+                return self._where(normed_inpt, inpt, mask)
 
             return normed_inpt
 
     def reverse(self, inpt: T.Tensor, mask: Optional[T.BoolTensor] = None) -> T.Tensor:
         """Unnormalises the inputs given the recorded stats."""
-        sel_inpt = self._mask(inpt, mask)
-        unnormed_inpt = sel_inpt * self.vars.sqrt() + self.means
+        unnormed_inpt = inpt * self.vars.sqrt() + self.means
 
-        # Undo the masking
+        # Leave the padded elements untouched
         if mask is not None:
-            inpt = inpt.clone()  # prevents inplace operation, bad for autograd
-            inpt[mask] = unnormed_inpt
-            return inpt
+            return self._where(unnormed_inpt, inpt, mask)
 
         return unnormed_inpt
 
@@ -487,7 +610,7 @@ class IterativeNormLayer(nn.Module):
             self.vars = self.m2 / self.n
 
         # Freeze the model if we exceed the requested stats
-        self.frozen = self.n >= self.max_n
+        self.frozen = bool(self.n >= self.max_n)
 
 
 class CosineEncoding:
@@ -1,20 +1,19 @@
 import copy
+from contextlib import contextmanager, nullcontext
 from functools import partial
-from typing import Mapping, Optional, Tuple
+from typing import Iterator, Mapping, Optional, Tuple
 
-import numpy as np
 import pytorch_lightning as pl
 import torch as T
 import wandb
-from jetnet.evaluation import w1efp, w1m, w1p
 
-from src.models.diffusion import VPDiffusionSchedule, run_sampler
-from src.models.modules import CosineEncoding, IterativeNormLayer
+from src.evaluation import AsyncEvaluator, jetnet_metrics, prepare_for_metrics
+from src.metrics import resolve_rng
+from src.models.diffusion import VPDiffusionSchedule, ddim_predict, run_sampler
+from src.models.modules import CosineEncoding, IterativeNormLayer, MLPBlock
 from src.models.schedulers import WarmupToConstant
-from src.models.transformers import FullTransformerEncoder
-from src.numpy_utils import undo_log_squash
-from src.plotting import plot_mpgan_marginals
-from src.torch_utils import get_loss_fn, to_np
+from src.models.transformers import FullTransformerEncoder, MultiHeadedAttentionBlock
+from src.torch_utils import BatchBuffer, get_loss_fn
 
 
 class TransformerDiffusionGenerator(pl.LightningModule):
@@ -34,8 +33,18 @@ class TransformerDiffusionGenerator(pl.LightningModule):
         loss_name: str = "mse",
         mle_loss_weight: float = 0.0,
         ema_sync: float = 0.999,
+        ema_every: int = 1,
+        ema_device: Optional[str] = None,
+        ema_dtype: Optional[str] = None,
+        autocast_dtype: Optional[str] = None,
         sampler_name: str = "em",
         sampler_steps: int = 100,
+        distill_config: Optional[Mapping] = None,
+        prefit_normalisers: bool = False,
+        val_n_jets: Optional[int] = None,
+        val_seed: int = 0,
+        val_workers: int = 0,
+        val_efp_jobs: int = 1,
     ) -> None:
         """
         Args:
@@ -49,10 +58,35 @@ class TransformerDiffusionGenerator(pl.LightningModule):
             optimizer: Partially initialised optimizer
             sched_config: The config for how to apply the scheduler
             ema_sync: How fast the ema network syncs with the given one
+            ema_every: Update the ema network every this many steps, the decay is
+                corrected so the averaging time is unchanged
+            ema_device: Keep the running average on this device (eg: cpu) and only
+                copy it to the ema network for validation and checkpoints
+            ema_dtype: As above but with a different precision (eg: float64)
+            autocast_dtype: Run the transformer under autocast with this reduced
+                precision (eg: bfloat16) in training and sampling. The schedule,
+                sampler, softmax and ema updates all stay in full precision, so
+                the fused attention backend is not supported
             loss_name: Name of the loss function to use for noise estimation
             mle_loss_weight: Relative weight of the Maximum-Liklihood loss term
             sampler_name: Name of O/SDE solver, does not effect training.
             sampler_steps: Steps used in generation, does not effect training.
+            distill_config: Train as the student of progressive distillation,
+                with the keys teacher_ckpt (a trained model with the same config)
+                and student_steps. Each DDIM step of the student learns two of
+                the teacher and it generates with the distilled sampler. The
+                student network predicts the velocity rather than the noise.
+            prefit_normalisers: Fit and freeze the normalisers with one pass over
+                the training data before training, instead of updating them
+                during the first steps.
+            val_n_jets: Number of jets generated each validation epoch, None for
+                the entire validation set
+            val_seed: Seed for the noise of the validation generation, so every
+                epoch starts from the same noise
+            val_workers: Processes which calculate the metrics and plots while
+                training continues, zero runs them at the end of the epoch so
+                the monitored metrics are always those of the current epoch
+            val_efp_jobs: Processes used to calculate the EFPs of the jets
         """
         super().__init__()
         self.save_hyperparameters(logger=False)
@@ -64,6 +98,11 @@ class TransformerDiffusionGenerator(pl.LightningModule):
         self.loss_fn = get_loss_fn(loss_name)
         self.mle_loss_weight = mle_loss_weight
         self.ema_sync = ema_sync
+        self.ema_every = ema_every
+        self.ema_device = ema_device
+        self.ema_dtype = getattr(T, ema_dtype) if ema_dtype else None
+        self.prefit_normalisers = prefit_normalisers
+        self.autocast_dtype = getattr(T, autocast_dtype) if autocast_dtype else None
 
         # The encoder and scheduler needed for diffusion
         self.diff_sched = VPDiffusionSchedule(**diff_config)
@@ -82,6 +121,15 @@ class TransformerDiffusionGenerator(pl.LightningModule):
             **trans_enc_config,
         )
 
+        # The fused kernels do not guarantee a full precision softmax under autocast
+        if self.autocast_dtype is not None and any(
+            isinstance(module, MultiHeadedAttentionBlock) and module.backend == "fused"
+            for module in self.net.modules()
+        ):
+            raise ValueError(
+                "The fused attention backend can not be used with autocast"
+            )
+
         # A copy of the network which will sync with an exponential moving average
         self.ema_net = copy.deepcopy(self.net)
 
@@ -89,8 +137,29 @@ class TransformerDiffusionGenerator(pl.LightningModule):
         self.sampler_name = sampler_name
         self.sampler_steps = sampler_steps
 
-        # Record of the outputs of the validation step
-        self.val_outs = []
+        # A distilled student can only sample on the grid it was trained for
+        self.distill_config = distill_config
+        if distill_config is not None:
+            self.sampler_name = "distilled"
+            self.sampler_steps = distill_config["student_steps"]
+        self._teacher = None
+
+        # Record of the outputs of the validation step, allocated once per run
+        self.val_outs = BatchBuffer()
+        self.val_n_jets = val_n_jets
+        self.val_seed = val_seed
+        self.val_efp_jobs = val_efp_jobs
+        self._val_gen = None
+        self._val_reference = None
+
+        # Calculates the validation metrics in the background
+        self.evaluator = AsyncEvaluator(val_workers)
+
+        # The precomputed context embedding used during sampling
+        self._ctxt_cache = None
+
+        # Seperate copy of the running average, only with an ema device or dtype
+        self._ema_shadow = None
 
     def forward(
         self,
@@ -98,9 +167,29 @@ class TransformerDiffusionGenerator(pl.LightningModule):
         diffusion_times: T.Tensor,
         mask: T.BoolTensor,
         ctxt: Optional[T.Tensor] = None,
+        time_encoding: Optional[T.Tensor] = None,
     ) -> T.Tensor:
         """Pass through the model and get an estimate of the noise added to the
-        input."""
+        input, the encoding of the times can be given if already calculated."""
+        outputs = self._network_outputs(
+            noisy_data, diffusion_times, mask, ctxt, time_encoding
+        )
+
+        # A distilled student predicts the velocity, which is converted to the noise
+        if self.distill_config is not None:
+            signal_rates, noise_rates = self.diff_sched(diffusion_times.view(-1, 1, 1))
+            outputs = signal_rates * outputs + noise_rates * noisy_data
+        return outputs
+
+    def _network_outputs(
+        self,
+        noisy_data: T.Tensor,
+        diffusion_times: T.Tensor,
+        mask: T.BoolTensor,
+        ctxt: Optional[T.Tensor] = None,
+        time_encoding: Optional[T.Tensor] = None,
+    ) -> T.Tensor:
+        """The raw outputs of the network, the noise or the velocity if distilled."""
 
         # Use the appropriate network for training or validation
         if self.training:
@@ -109,12 +198,51 @@ class TransformerDiffusionGenerator(pl.LightningModule):
             network = self.ema_net
 
         # Encode the times and combine with existing context info
-        context = self.time_encoder(diffusion_times)
+        if time_encoding is None:
+            time_encoding = self.time_encoder(diffusion_times)
+        context = time_encoding
+        ctxt_cache = None
         if self.ctxt_dim:
-            context = T.cat([context, ctxt], dim=-1)
+
+            # Reuse the embedding of the static context if it was cached
+            if self._ctxt_cache is not None:
+                cached_ctxt, cached_net, cached_embd = self._ctxt_cache
+                if ctxt is cached_ctxt and network is cached_net:
+                    ctxt_cache = cached_embd
+
+            if ctxt_cache is None:
+                context = T.cat([context, ctxt], dim=-1)
 
         # Use the selected network to esitmate the noise present in the data
-        return network(noisy_data, mask=mask, ctxt=context)
+        with self._autocast():
+            outputs = network(
+                noisy_data, mask=mask, ctxt=context, ctxt_cache=ctxt_cache
+            )
+
+        # Everything outside of the network stays in the original precision
+        return outputs.to(noisy_data.dtype)
+
+    def _autocast(self):
+        """The reduced precision context for the network, if it was requested."""
+        if self.autocast_dtype is None:
+            return nullcontext()
+        return T.autocast(self.device.type, dtype=self.autocast_dtype)
+
+    @contextmanager
+    def cached_context(self, ctxt: T.Tensor):
+        """Within this context, forward passes with this exact ctxt tensor reuse
+        a single embedding of it rather than reprocessing it every call.
+
+        Only the time encoding is then passed through the first context layer on
+        each step of the sampler.
+        """
+        network = self.net if self.training else self.ema_net
+        with self._autocast():
+            self._ctxt_cache = (ctxt, network, network.embed_static_ctxt(ctxt))
+        try:
+            yield
+        finally:
+            self._ctxt_cache = None
 
     def _shared_step(self, sample: tuple) -> Tuple[T.Tensor, T.Tensor]:
         """Shared step used in both training and validaiton."""
@@ -127,6 +255,11 @@ class TransformerDiffusionGenerator(pl.LightningModule):
         if self.ctxt_dim:
             ctxt = self.ctxt_normaliser(ctxt)
 
+        # The targets of the student come from the teacher when distilling
+        if self._teacher is not None:
+            distill_loss = self._distillation_loss(nodes, mask, ctxt)
+            return distill_loss, T.zeros_like(distill_loss)
+
         # Sample from the gaussian latent space to perturb the point clouds
         noises = T.randn_like(nodes) * mask.unsqueeze(-1)
 
@@ -153,6 +286,60 @@ class TransformerDiffusionGenerator(pl.LightningModule):
 
         return simple_loss.mean(), mle_loss.mean()
 
+    def _distillation_loss(
+        self, nodes: T.Tensor, mask: T.BoolTensor, ctxt: Optional[T.Tensor]
+    ) -> T.Tensor:
+        """Data loss of the student against two DDIM steps of the teacher, as
+        in progressive distillation https://arxiv.org/abs/2202.00512
+
+        The target is the data for which a single DDIM step of the student lands
+        where the two steps of the teacher do. The student predicts the velocity
+        v = signal_rate * noise - noise_rate * data, so its predicted data stays
+        well conditioned at high noise where predicting the noise would amplify
+        the errors by 1 / signal_rate. The loss uses the truncated SNR weighting.
+        """
+        n_steps = self.distill_config["student_steps"]
+
+        # Each jet starts at a random step of the student, two on the teacher grid
+        starts = 2 * T.randint(0, n_steps, (len(nodes),), device=self.device)
+        times, signal_rates, noise_rates, _, _ = self.diff_sched.get_table(
+            2 * n_steps, self.device
+        )
+        rates = lambda i: (
+            signal_rates[starts + i].view(-1, 1, 1),
+            noise_rates[starts + i].view(-1, 1, 1),
+        )
+
+        # Mix the signal and noise according to the diffusion equation
+        noises = T.randn_like(nodes) * mask.unsqueeze(-1)
+        signal_rate, noise_rate = rates(0)
+        noisy_nodes = signal_rate * nodes + noise_rate * noises
+
+        # Take two DDIM steps with the teacher
+        target_nodes = noisy_nodes
+        with T.no_grad():
+            for i in range(2):
+                pred_noises = self._teacher(target_nodes, times[starts + i], mask, ctxt)
+                pred_data = ddim_predict(target_nodes, pred_noises, *rates(i))
+                next_signal_rate, next_noise_rate = rates(i + 1)
+                target_nodes = (
+                    next_signal_rate * pred_data + next_noise_rate * pred_noises
+                )
+
+        # Invert a single DDIM step from the start to the end point of the teacher
+        end_signal_rate, end_noise_rate = rates(2)
+        ratio = end_noise_rate / noise_rate
+        target_data = (target_nodes - ratio * noisy_nodes) / (
+            end_signal_rate - ratio * signal_rate
+        )
+
+        # Predict the data from the velocity given by the network
+        pred_velocity = self._network_outputs(noisy_nodes, times[starts], mask, ctxt)
+        pred_data = signal_rate * noisy_nodes - noise_rate * pred_velocity
+        weights = (signal_rate / noise_rate).square().clamp(min=1)
+        distill_loss = self.loss_fn(target_data, pred_data) * weights
+        return distill_loss[mask].mean()
+
     def training_step(self, sample: tuple, _batch_idx: int) -> T.Tensor:
         simple_loss, mle_loss = self._shared_step(sample)
         total_loss = simple_loss + self.mle_loss_weight * mle_loss
@@ -169,74 +356,164 @@ class TransformerDiffusionGenerator(pl.LightningModule):
         self.log("valid/mle_loss", mle_loss)
         self.log("valid/total_loss", total_loss)
 
+        # Only generate until the budget of jets for this epoch is reached
+        n_done = len(self.val_outs)
+        n_gen = len(sample[1])
+        if self.val_n_jets is not None:
+            n_gen = min(n_gen, self.val_n_jets - n_done)
+        if n_gen <= 0:
+            return
+        sample = tuple(x[:n_gen] for x in sample)
+
         # Run the full generation of the sample during a validation step
+        initial_noise = T.randn(
+            (*sample[1].shape, self.pc_dim), device=self.device, generator=self._val_gen
+        )
         outputs = self.full_generation(
             self.sampler_name,
             self.sampler_steps,
             mask=sample[1],
             ctxt=sample[2],
+            initial_noise=initial_noise,
         )
 
         # Add to the collection of the validaiton outputs
-        self.val_outs.append((to_np(outputs), to_np(sample)))
+        self.val_outs.append(outputs, *sample)
+
+    def on_validation_epoch_start(self) -> None:
+        """Restart the noise generator so each epoch uses the same noise and
+        empty the record of the outputs, sized to hold the validation jets."""
+        self._val_gen = T.Generator(self.device).manual_seed(self.val_seed)
+        n_jets = len(self.trainer.datamodule.valid_set)
+        if self.val_n_jets is not None:
+            n_jets = min(n_jets, self.val_n_jets)
+        self.val_outs.reset(n_jets)
 
     def on_validation_epoch_end(self) -> None:
-        """At the end of the validation epoch, calculate and log the metrics
-        and plot the histograms.
+        """At the end of the validation epoch, send the generated jets away to
+        calculate the metrics and plot the histograms.
 
         This function right now only works with MPGAN configs
         """
+        if not len(self.val_outs):
+            return
+
+        # The outputs were already collected into contiguous arrays
+        gen_nodes, real_nodes, mask, high = self.val_outs.arrays()
+
+        # Change into the jetnet format used by the metrics
+        log_squash_pt = self.trainer.datamodule.hparams.data_conf.log_squash_pt
+        gen_nodes = prepare_for_metrics(gen_nodes, high, log_squash_pt)
+        real_nodes = prepare_for_metrics(real_nodes, high, log_squash_pt)
+
+        # The mask is a view of the reused buffer, but workers pickle it later
+        if self.evaluator.n_workers:
+            mask = mask.copy()
+
+        # Calculate the metrics in the background and log any which are finished,
+        # the bootstrap is seeded here as the workers do not share the global state
+        self.evaluator.submit(
+            self.global_step,
+            jetnet_metrics,
+            gen_nodes,
+            real_nodes,
+            mask,
+            self.trainer.current_epoch,
+            self.val_efp_jobs,
+            self._val_reference,
+            resolve_rng(),
+        )
+        self._log_evaluations()
 
-        # Combine all outputs
-        gen_nodes = np.vstack([v[0] for v in self.val_outs])
-        real_nodes = np.vstack([v[1][0] for v in self.val_outs])
-        mask = np.vstack([v[1][1] for v in self.val_outs])
-        high = np.vstack([v[1][2] for v in self.val_outs])
-
-        # Change the data from log(pt+1) into pt fraction (needed for metrics)
-        if self.trainer.datamodule.hparams.data_conf.log_squash_pt:
-            gen_nodes[..., -1] = undo_log_squash(gen_nodes[..., -1]) / high[..., 0:1]
-            real_nodes[..., -1] = undo_log_squash(real_nodes[..., -1]) / high[..., 0:1]
-
-        # Apply clipping
-        gen_nodes = np.nan_to_num(gen_nodes)
-        gen_nodes[..., 0] = np.clip(gen_nodes[..., 0], -0.5, 0.5)
-        gen_nodes[..., 1] = np.clip(gen_nodes[..., 1], -0.5, 0.5)
-        gen_nodes[..., 2] = np.clip(gen_nodes[..., 2], 0, 1)
-        real_nodes = np.nan_to_num(real_nodes)
-        real_nodes[..., 0] = np.clip(real_nodes[..., 0], -0.5, 0.5)
-        real_nodes[..., 1] = np.clip(real_nodes[..., 1], -0.5, 0.5)
-        real_nodes[..., 2] = np.clip(real_nodes[..., 2], 0, 1)
-
-        # Calculate and log the Wasserstein discriminants
-        bootstrap = {
-            "num_eval_samples": 10000,
-            "num_batches": 10,
-        }
-        w1m_val, w1m_err = w1m(real_nodes, gen_nodes, **bootstrap)
-        w1p_val, w1p_err = w1p(real_nodes, gen_nodes, **bootstrap)
-        w1efp_val, w1efp_err = w1efp(real_nodes, gen_nodes, efp_jobs=1, **bootstrap)
-        self.log("valid/w1m", w1m_val)
-        self.log("valid/w1m_err", w1m_err)
-        self.log("valid/w1p", w1p_val.mean())
-        self.log("valid/w1p_err", w1p_err.mean())
-        self.log("valid/w1efp", w1efp_val.mean())
-        self.log("valid/w1efp_err", w1efp_err.mean())
-
-        # Plot the MPGAN-like marginals
-        plot_mpgan_marginals(gen_nodes, real_nodes, mask, self.trainer.current_epoch)
-        self.val_outs.clear()
+    def on_train_epoch_end(self) -> None:
+        self._log_evaluations()
+
+    def on_fit_end(self) -> None:
+        self._log_evaluations(wait=True)
+        self.evaluator.shutdown()
+
+    def _log_evaluations(self, wait: bool = False) -> None:
+        """Log the metrics and images of the finished validation evaluations
+        against the step at which they were submitted.
+
+        The metrics go to every logger and into the callback metrics, so they can
+        be monitored (eg: by checkpointing or early stopping). With val_workers
+        these are the last finished evaluation, which may lag behind the epoch.
+        """
+        for step, (metrics, images, reference) in self.evaluator.collect(wait):
+            cst_img, jet_img = images
+            self._val_reference = reference
+            for logger in self.loggers:
+                logger.log_metrics(metrics, step=step)
+            self.trainer.callback_metrics.update(
+                {key: T.tensor(float(value)) for key, value in metrics.items()}
+            )
+            if wandb.run is not None:
+                gen_table = wandb.Table(columns=["constituents", "jets"])
+                gen_table.add_data(wandb.Image(cst_img), wandb.Image(jet_img))
+                wandb.run.log({"generated": gen_table}, commit=False)
 
     def _sync_ema_network(self) -> None:
-        """Updates the Exponential Moving Average Network."""
+        """Updates the Exponential Moving Average Network.
+
+        All parameters are updated at once with the multi-tensor kernels and the
+        buffers are copied over.
+        """
+        if self.global_step % self.ema_every:
+            return
+
         with T.no_grad():
-            for params, ema_params in zip(
-                self.net.parameters(), self.ema_net.parameters()
-            ):
-                ema_params.data.copy_(
-                    self.ema_sync * ema_params.data
-                    + (1.0 - self.ema_sync) * params.data
-                )
+            ema_params, ema_buffers = self._ema_shadow or (
+                list(self.ema_net.parameters()),
+                list(self.ema_net.buffers()),
+            )
+            params = [p.detach() for p in self.net.parameters()]
+            buffers = list(self.net.buffers())
+
+            # Bring the network over to the shadow device and dtype
+            if self._ema_shadow is not None:
+                params = [p.to(ema_params[0]) for p in params]
+                buffers = [b.to(e) for b, e in zip(buffers, ema_buffers)]
+
+            weight = 1.0 - self.ema_sync**self.ema_every
+            T._foreach_lerp_(ema_params, params, weight)
+            if buffers:
+                T._foreach_copy_(ema_buffers, buffers)
+
+    def _init_ema_shadow(self) -> None:
+        """Create the shadow copy of the ema network on the requested device and
+        with the requested precision."""
+        if self.ema_device is None and self.ema_dtype is None:
+            return
+        device = self.ema_device or self.device
+        self._ema_shadow = (
+            [
+                p.detach().to(device, self.ema_dtype, copy=True)
+                for p in self.ema_net.parameters()
+            ],
+            [b.to(device, copy=True) for b in self.ema_net.buffers()],
+        )
+
+    def _load_ema_shadow(self) -> None:
+        """Copy the shadow running average into the ema network."""
+        if self._ema_shadow is None:
+            return
+        with T.no_grad():
+            for param, shadow in zip(self.ema_net.parameters(), self._ema_shadow[0]):
+                param.copy_(shadow)
+            for buffer, shadow in zip(self.ema_net.buffers(), self._ema_shadow[1]):
+                buffer.copy_(shadow)
+
+    def on_validation_start(self) -> None:
+        self._load_ema_shadow()
+
+    def on_save_checkpoint(self, checkpoint: dict) -> None:
+        """Save the latest running average when it is kept in the shadow."""
+        if self._ema_shadow is not None:
+            self._load_ema_shadow()
+            state_dict = checkpoint["state_dict"]
+            for name, tensor in self.ema_net.state_dict().items():
+                state_dict[f"ema_net.{name}"] = tensor
 
     def on_fit_start(self, *_args) -> None:
         """Function to run at the start of training."""
@@ -253,6 +530,111 @@ class TransformerDiffusionGenerator(pl.LightningModule):
             wandb.define_metric("valid/w1p", summary="min")
             wandb.define_metric("valid/w1efp", summary="min")
 
+        # The student starts as the teacher, before the shadow copies the ema
+        if self.distill_config is not None:
+            self._load_teacher()
+
+        # The ema network may be restored from a checkpoint before this point
+        self._init_ema_shadow()
+
+        # Exact stats for the normalisers, so the training steps never update them
+        if self.prefit_normalisers:
+            self._prefit_normalisers()
+
+    def _prefit_normalisers(self) -> None:
+        """Fit the normalisers with a single streaming pass over the whole training
+        set and freeze them, stats restored from a checkpoint are only frozen."""
+        fit_nodes = self.normaliser.n == 0
+        fit_ctxt = bool(self.ctxt_dim) and self.ctxt_normaliser.n == 0
+        if fit_nodes or fit_ctxt:
+            self._fit_normalisers(fit_nodes, fit_ctxt)
+        self.normaliser.frozen = True
+        if self.ctxt_dim:
+            self.ctxt_normaliser.frozen = True
+
+    def _fit_normalisers(self, fit_nodes: bool, fit_ctxt: bool) -> None:
+        """Fit the requested normalisers in one ordered pass over the training set."""
+
+        # Every jet is seen exactly once, so the stats are exact
+        datamodule = self.trainer.datamodule
+        loader = datamodule.make_loader(
+            datamodule.train_set, shuffle=False, drop_last=False
+        )
+
+        # The context is a single row per jet, so it is kept from the same pass
+        ctxts = []
+
+        def node_stream() -> Iterator[tuple]:
+            for nodes, mask, ctxt in loader:
+                if fit_ctxt:
+                    ctxts.append(ctxt)
+                yield nodes, mask
+
+        if fit_nodes:
+            self.normaliser.fit_stream(node_stream())
+        else:
+            ctxts = [ctxt for _, _, ctxt in loader]
+        if fit_ctxt:
+            self.ctxt_normaliser.fit_stream((ctxt, None) for ctxt in ctxts)
+
+    def _load_teacher(self) -> None:
+        """Load the frozen teacher for progressive distillation and copy its
+        ema network and normalisers into the student, unless resuming."""
+        teacher = TransformerDiffusionGenerator.load_from_checkpoint(
+            self.distill_config["teacher_ckpt"], map_location=self.device
+        )
+        teacher.eval().requires_grad_(False)
+
+        # A distilled teacher must be sampled on its own grid
+        n_steps = 2 * self.distill_config["student_steps"]
+        if teacher.distill_config is not None and teacher.sampler_steps != n_steps:
+            raise ValueError(
+                f"The teacher was distilled for {teacher.sampler_steps} steps but "
+                f"the student learns to halve {n_steps}"
+            )
+
+        # Not registered as a submodule, so it is never optimised or saved
+        object.__setattr__(self, "_teacher", teacher)
+
+        # Otherwise the student was restored from a checkpoint before this point
+        if self.trainer.ckpt_path is None:
+            self.net.load_state_dict(teacher.ema_net.state_dict())
+            self.ema_net.load_state_dict(teacher.ema_net.state_dict())
+            self.normaliser.load_state_dict(teacher.normaliser.state_dict())
+            if self.ctxt_dim:
+                self.ctxt_normaliser.load_state_dict(
+                    teacher.ctxt_normaliser.state_dict()
+                )
+
+        # The student and teacher must see the same normalised inputs
+        self.normaliser.frozen = True
+        if self.ctxt_dim:
+            self.ctxt_normaliser.frozen = True
+
+    def quantize_ema_network(self) -> None:
+        """Replace the ema network with a copy where the weights of the linear
+        layers are dynamically quantised to INT8, for faster generation on CPU.
+
+        The context embedding is kept in full precision as it is only evaluated
+        once per generation. The quantised network can not be trained, synced
+        or saved, so this should only be used for inference.
+        """
+        # The context of each block is split off to be quantised with its own range
+        for module in self.ema_net.modules():
+            if isinstance(module, MLPBlock):
+                module.split_context_layer()
+
+        qconfig = T.ao.quantization.default_dynamic_qconfig
+        qconfig_spec = {
+            name: qconfig
+            for name, module in self.ema_net.named_modules()
+            if isinstance(module, T.nn.Linear) and not name.startswith("ctxt_emdb")
+        }
+        self.ema_net = T.ao.quantization.quantize_dynamic(
+            self.ema_net.cpu(), qconfig_spec, dtype=T.qint8
+        )
+        self._ema_shadow = None
+
     def set_sampler(
         self, sampler_name: Optional[str] = None, sampler_steps: Optional[int] = None
     ) -> None:
@@ -269,9 +651,18 @@ class TransformerDiffusionGenerator(pl.LightningModule):
         mask: Optional[T.BoolTensor] = None,
         ctxt: Optional[T.Tensor] = None,
         initial_noise: Optional[T.Tensor] = None,
+        bucket_size: Optional[int] = None,
+        **sampler_kwargs,
     ) -> T.Tensor:
         """Fully generate a batch of data from noise, given context information
-        and a mask."""
+        and a mask.
+
+        If bucket_size is given the jets are sorted by multiplicity and sampled
+        in buckets of this size, each trimmed to the largest jet in the bucket,
+        so the cost follows the real constituents rather than the padding.
+
+        Any extra keyword arguments are passed to the sampler (eg: rtol, atol).
+        """
 
         # Either a mask or initial noise must be defined or we dont know how
         # many samples to generate and with what cardinality
@@ -279,25 +670,42 @@ class TransformerDiffusionGenerator(pl.LightningModule):
             raise ValueError("Please provide either a mask or noise to generate from")
         if mask is None:
             mask = T.full(initial_noise.shape[:-1], True, device=self.device)
+
+        # A distilled student only learned the DDIM steps of a single grid
+        if sampler == "distilled":
+            if self.distill_config is None:
+                raise ValueError("The distilled sampler needs a distilled model")
+            if steps != self.distill_config["student_steps"]:
+                raise ValueError(
+                    f"This model was distilled for "
+                    f"{self.distill_config['student_steps']} steps, not {steps}"
+                )
         if initial_noise is None:
             initial_noise = T.randn((*mask.shape, self.pc_dim), device=self.device)
 
+        if bucket_size is not None:
+            return self._bucketed_generation(
+                sampler, steps, mask, ctxt, initial_noise, bucket_size, **sampler_kwargs
+            )
+
         # Normalise the context
         if self.ctxt_dim:
             ctxt = self.ctxt_normaliser(ctxt)
             assert len(ctxt) == len(initial_noise)
 
-        # Run the sampling method
-        outputs, _ = run_sampler(
-            sampler,
-            self,
-            self.diff_sched,
-            initial_noise=initial_noise * mask.unsqueeze(-1),
-            n_steps=steps,
-            mask=mask,
-            ctxt=ctxt,
-            clip_predictions=(-25, 25),
-        )
+        # Run the sampling method, the context embedding is only calculated once
+        with self.cached_context(ctxt) if self.ctxt_dim else nullcontext():
+            outputs, _ = run_sampler(
+                sampler,
+                self,
+                self.diff_sched,
+                initial_noise=initial_noise * mask.unsqueeze(-1),
+                n_steps=steps,
+                mask=mask,
+                ctxt=ctxt,
+                clip_predictions=(-25, 25),
+                **sampler_kwargs,
+            )
 
         # Ensure that the output adheres to the mask
         outputs[~mask] = 0
@@ -305,6 +713,47 @@ class TransformerDiffusionGenerator(pl.LightningModule):
         # Return the normalisation of the generated point cloud
         return self.normaliser.reverse(outputs, mask=mask)
 
+    def _bucketed_generation(
+        self,
+        sampler: str,
+        steps: int,
+        mask: T.BoolTensor,
+        ctxt: Optional[T.Tensor],
+        initial_noise: T.Tensor,
+        bucket_size: int,
+        **sampler_kwargs,
+    ) -> T.Tensor:
+        """Run full_generation on buckets of jets with similar multiplicity with
+        the padded nodes trimmed away, then scatter back to the original order.
+
+        The network is permutation equivariant so the valid nodes of each jet
+        can be moved to the front without changing the output.
+        """
+
+        # Order the jets by multiplicity and the nodes of each jet valid first
+        mult = mask.sum(dim=-1)
+        jet_order = T.argsort(mult, stable=True)
+        node_order = T.argsort((~mask).byte(), dim=-1, stable=True)
+
+        outputs = T.zeros_like(initial_noise)
+        for jet_idx in T.split(jet_order, bucket_size):
+            n_nodes = max(int(mult[jet_idx].max()), 1)
+            node_idx = node_order[jet_idx, :n_nodes]
+            gather_idx = node_idx.unsqueeze(-1).expand(-1, -1, outputs.shape[-1])
+
+            # Generate the trimmed bucket and place it back in the full tensor
+            bucket_outputs = self.full_generation(
+                sampler,
+                steps,
+                mask=mask[jet_idx].gather(1, node_idx),
+                ctxt=ctxt[jet_idx] if self.ctxt_dim else ctxt,
+                initial_noise=initial_noise[jet_idx].gather(1, gather_idx),
+                **sampler_kwargs,
+            )
+            outputs[jet_idx] = outputs[jet_idx].scatter(1, gather_idx, bucket_outputs)
+
+        return outputs
+
     def configure_optimizers(self) -> dict:
         """Configure the optimisers and learning rate sheduler for this
         model."""
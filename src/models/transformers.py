@@ -5,9 +5,14 @@ from typing import Mapping, Optional, Union
 
 import torch as T
 import torch.nn as nn
-from torch.nn.functional import dropout, softmax
+from torch.nn.functional import (
+    dropout,
+    linear,
+    scaled_dot_product_attention,
+    softmax,
+)
 
-from .modules import DenseNetwork
+from .modules import DenseNetwork, linear_params
 
 
 def merge_masks(
@@ -81,11 +86,12 @@ def attention(
     if attn_mask is not None:
         scores = scores.masked_fill(~attn_mask.unsqueeze(-3), -T.inf)
 
-    # Apply the softmax function per head feature
-    scores = softmax(scores, dim=-1)
+    # Apply the softmax function per head feature, upcasting reduced precisions
+    upcast = scores.dtype in (T.float16, T.bfloat16)
+    scores = softmax(scores, dim=-1, dtype=T.float32 if upcast else None)
 
     # Kill the nans introduced by the padded query elements
-    scores = T.nan_to_num(scores, 0)
+    scores = T.nan_to_num(scores, 0).to(value.dtype)
 
     # Apply dropout to the attention scores
     scores = dropout(scores, p=drp, training=training)
@@ -96,6 +102,57 @@ def attention(
     return scores
 
 
+def fused_attention(
+    query: T.Tensor,
+    key: T.Tensor,
+    value: T.Tensor,
+    attn_mask: Optional[T.BoolTensor] = None,
+    attn_bias: Optional[T.Tensor] = None,
+    drp: float = 0.0,
+    training: bool = True,
+) -> T.Tensor:
+    """Apply the same attention as above but using the fused pytorch kernels,
+    which never materialise the intermediate score matrices.
+
+    The fused kernels return nans for queries which can not attend to anything
+    (eg: the padded elements). So these rows are allowed to attend to everything
+    and their outputs are set to zero afterwards, matching the nan_to_num above.
+
+    Args:
+        query: Batched query sequence of tensors (b, h, s, f)
+        key: Batched key sequence of tensors (b, h, s, f)
+        value: Batched value sequence of tensors (b, h, s, f)
+        attn_mask: The attention mask, used to blind certain combinations of k,q pairs
+        attn_bias: Extra weights to combine with attention weights
+        drp: Dropout probability
+        training: If the model is in training mode, effects the dropout applied
+    """
+
+    # Find the queries with no valid keys and unblind them
+    empty = None
+    if attn_mask is not None:
+        empty = ~attn_mask.any(dim=-1, keepdim=True)
+        attn_mask = (attn_mask | empty).unsqueeze(-3)
+
+    # The bias terms and mask must be combined into a single additive mask
+    if attn_bias is not None:  # Move the head dimension to the first
+        attn_bias = attn_bias.permute(0, 3, 1, 2).to(query.dtype)
+        if attn_mask is not None:
+            attn_bias = attn_bias.masked_fill(~attn_mask, -T.inf)
+        attn_mask = attn_bias
+
+    # Run the fused kernel, the scale defaults to 1/sqrt(head_dim)
+    scores = scaled_dot_product_attention(
+        query, key, value, attn_mask=attn_mask, dropout_p=drp if training else 0.0
+    )
+
+    # Kill the outputs of the queries which could not attend to anything
+    if empty is not None:
+        scores = scores.masked_fill(empty.unsqueeze(-3), 0)
+
+    return scores
+
+
 class MultiHeadedAttentionBlock(nn.Module):
     """Generic Multiheaded Attention.
 
@@ -118,6 +175,7 @@ class MultiHeadedAttentionBlock(nn.Module):
     - q = q_linear * q
     - k = k_linear * k
     - v = v_linear * v
+    - If fuse_qkv then these are a single layer, one matmul for self attention
 
     2) Outputs are reshaped to add a head dimension, and transposed for matmul.
     - features = model_dim = head_dim * num_heads
@@ -137,6 +195,8 @@ class MultiHeadedAttentionBlock(nn.Module):
         model_dim: int,
         num_heads: int = 1,
         drp: float = 0,
+        backend: str = "math",
+        fuse_qkv: bool = False,
     ) -> None:
         """
         Args:
@@ -144,6 +204,13 @@ class MultiHeadedAttentionBlock(nn.Module):
             num_heads: The number of different attention heads to process in parallel
                 - Must allow interger division into model_dim
             drp: The dropout probability used in the MHA operation
+            backend: How the attention is calculated
+                - math: Explicit matrix multiplications and softmax
+                - fused: Pytorch's fused scaled_dot_product_attention kernels
+                  (under autocast the softmax precision is up to the kernel)
+            fuse_qkv: Hold the q, k, v projections in a single linear layer
+                - Self attention then only needs one matmul for all three
+                - Checkpoints with either layout can be loaded
         """
         super().__init__()
 
@@ -156,13 +223,59 @@ class MultiHeadedAttentionBlock(nn.Module):
         if self.head_dim * num_heads != model_dim:
             raise ValueError("Model dimension must be divisible by number of heads!")
 
+        # Check that the attention backend exists
+        if backend not in ["math", "fused"]:
+            raise ValueError(f"Unknown attention backend: {backend}")
+        self.backend = backend
+
         # Initialise the weight matrices
-        self.q_linear = nn.Linear(model_dim, model_dim)
-        self.k_linear = nn.Linear(model_dim, model_dim)
-        self.v_linear = nn.Linear(model_dim, model_dim)
+        self.fuse_qkv = fuse_qkv
+        if fuse_qkv:
+            self.qkv_linear = nn.Linear(model_dim, 3 * model_dim)
+        else:
+            self.q_linear = nn.Linear(model_dim, model_dim)
+            self.k_linear = nn.Linear(model_dim, model_dim)
+            self.v_linear = nn.Linear(model_dim, model_dim)
         self.out_linear = nn.Linear(model_dim, model_dim)
         self.drp = drp
 
+    def _project_qkv(self, q: T.Tensor, k: T.Tensor, v: T.Tensor) -> tuple:
+        """Apply the q, k, v projections and split the features into heads."""
+        shape = (q.shape[0], -1, self.num_heads, self.head_dim)
+
+        # Seperate layers
+        if not self.fuse_qkv:
+            q = self.q_linear(q).view(shape)
+            k = self.k_linear(k).view(shape)
+            v = self.v_linear(v).view(shape)
+            return q, k, v
+
+        # Self attention with the fused layer only needs a single matmul
+        if q is k and k is v:
+            qkv = self.qkv_linear(q).view(*shape[:2], 3, *shape[2:])
+            return qkv.unbind(dim=2)
+
+        # Cross attention with the fused layer needs its weights split
+        weights, biases = linear_params(self.qkv_linear)
+        weights, biases = weights.chunk(3), biases.chunk(3)
+        q = linear(q, weights[0], biases[0]).view(shape)
+        k = linear(k, weights[1], biases[1]).view(shape)
+        v = linear(v, weights[2], biases[2]).view(shape)
+        return q, k, v
+
+    def _load_from_state_dict(self, state_dict: dict, prefix: str, *args) -> None:
+        """Convert between the seperate and fused q, k, v layers when loading,
+        so checkpoints saved with either layout can be used."""
+        for param in ["weight", "bias"]:
+            fused = f"{prefix}qkv_linear.{param}"
+            seperate = [f"{prefix}{x}_linear.{param}" for x in "qkv"]
+            if self.fuse_qkv and all(key in state_dict for key in seperate):
+                state_dict[fused] = T.cat([state_dict.pop(key) for key in seperate])
+            elif not self.fuse_qkv and fused in state_dict:
+                for key, tensor in zip(seperate, state_dict.pop(fused).chunk(3)):
+                    state_dict[key] = tensor
+        super()._load_from_state_dict(state_dict, prefix, *args)
+
     def forward(
         self,
         q: T.Tensor,
@@ -198,10 +311,7 @@ class MultiHeadedAttentionBlock(nn.Module):
         attn_mask = merge_masks(q_mask, kv_mask, attn_mask, q.shape, k.shape, q.device)
 
         # Generate the q, k, v projections, break final head dimension in 2
-        shape = (b_size, -1, self.num_heads, self.head_dim)
-        q = self.q_linear(q).view(shape)
-        k = self.k_linear(k).view(shape)
-        v = self.v_linear(v).view(shape)
+        q, k, v = self._project_qkv(q, k, v)
 
         # Transpose to get dimensions: B,H,Seq,HD (required for matmul)
         q = q.transpose(1, 2)
@@ -209,16 +319,27 @@ class MultiHeadedAttentionBlock(nn.Module):
         v = v.transpose(1, 2)
 
         # Calculate the new sequence values, for memory reasons overwrite q
-        q = attention(
-            q,
-            k,
-            v,
-            self.head_dim,
-            attn_mask=attn_mask,
-            attn_bias=attn_bias,
-            drp=self.drp,
-            training=self.training,
-        )  # Returned shape is B,H,Q_seq,HD
+        if self.backend == "fused":
+            q = fused_attention(
+                q,
+                k,
+                v,
+                attn_mask=attn_mask,
+                attn_bias=attn_bias,
+                drp=self.drp,
+                training=self.training,
+            )  # Returned shape is B,H,Q_seq,HD
+        else:
+            q = attention(
+                q,
+                k,
+                v,
+                self.head_dim,
+                attn_mask=attn_mask,
+                attn_bias=attn_bias,
+                drp=self.drp,
+                training=self.training,
+            )  # Returned shape is B,H,Q_seq,HD
 
         # Concatenate the all of the heads together to get shape: B,Seq,F
         q = q.transpose(1, 2).contiguous().view(b_size, -1, self.model_dim)
@@ -412,6 +533,16 @@ class FullTransformerEncoder(nn.Module):
                 **edge_embd_config,
             )
 
+    def embed_static_ctxt(self, static_ctxt: T.Tensor) -> T.Tensor:
+        """Precompute the part of the context embedding which comes from the
+        trailing context features.
+
+        This can then be passed as ctxt_cache to forward, alongside only the
+        leading context features, to avoid reprocessing context which does not
+        change between calls (eg: during diffusion sampling).
+        """
+        return self.ctxt_emdb.static_projection(static_ctxt)
+
     def forward(
         self,
         x: T.Tensor,
@@ -419,10 +550,11 @@ class FullTransformerEncoder(nn.Module):
         ctxt: Optional[T.Tensor] = None,
         attn_bias: Optional[T.Tensor] = None,
         attn_mask: Optional[T.BoolTensor] = None,
+        ctxt_cache: Optional[T.Tensor] = None,
     ) -> T.Tensor:
         """Pass the input through all layers sequentially."""
         if self.ctxt_dim:
-            ctxt = self.ctxt_emdb(ctxt)
+            ctxt = self.ctxt_emdb(ctxt, static_proj=ctxt_cache)
         if self.edge_dim:
             attn_bias = self.edge_embd(attn_bias, ctxt)
         x = self.node_embd(x, ctxt)
@@ -1,4 +1,6 @@
 # import jetnet
+from typing import Optional, Union
+
 import numpy as np
 import pytorch_lightning as pl
 import torch as T
@@ -7,31 +9,97 @@ import torch as T
 pl.seed_everything(0, workers=True)
 
 
-def locals_to_mass_and_pt(csts: T.Tensor, mask: T.BoolTensor) -> T.Tensor:
+def jet_kinematics(
+    csts: Union[T.Tensor, np.ndarray],
+    mask: Union[T.BoolTensor, np.ndarray],
+    pt_logged: bool = False,
+    double: bool = False,
+    chunk_size: Optional[int] = 10_000,
+) -> Union[T.Tensor, np.ndarray]:
     """Calculate the overall jet pt and mass from the constituents. The
     constituents are expected to be expressed as:
 
     - del_eta
     - del_phi
-    - log_pt
+    - log_pt or just pt depending on pt_logged
+
+    Works on both tensors and numpy arrays, returning the same type. Only the
+    valid constituents are used and their four-momenta are summed into the
+    jets with a single index_add, padded values (even NaNs) are never touched.
+
+    Args:
+        csts: The constituents of shape (n_jets, n_csts, 3)
+        mask: Which constituents are real of shape (n_jets, n_csts)
+        pt_logged: If the pt of the constituents is log(pt)
+        double: Calculate and return the values in float64
+        chunk_size: Process this many jets at a time, which keeps the temporary
+            arrays small enough to stay in the cache. None for all at once
+
+    Returns:
+        The pt and mass of each jet of shape (n_jets, 2)
     """
+    is_numpy = isinstance(csts, np.ndarray)
+    csts = T.as_tensor(csts)
+    mask = T.as_tensor(mask, device=csts.device).bool()
+    dtype = T.float64 if double else csts.dtype
+
+    # Process all in one go or fill the output a chunk at a time
+    if chunk_size is None or chunk_size >= len(csts):
+        jets = _jet_kinematics(csts, mask, pt_logged, dtype)
+    else:
+        jets = T.empty((len(csts), 2), dtype=dtype, device=csts.device)
+        for start in range(0, len(csts), chunk_size):
+            stop = start + chunk_size
+            jets[start:stop] = _jet_kinematics(
+                csts[start:stop], mask[start:stop], pt_logged, dtype
+            )
+
+    return jets.numpy() if is_numpy else jets
+
+
+def _jet_kinematics(
+    csts: T.Tensor, mask: T.BoolTensor, pt_logged: bool, dtype: T.dtype
+) -> T.Tensor:
+    """Calculate the jet pt and mass of a single chunk, see jet_kinematics."""
+
+    # The flat index of each valid constituent and the jet it belongs to
+    cst_idx = mask.reshape(-1).nonzero().squeeze(1)
+    jet_idx = cst_idx.div(mask.shape[-1], rounding_mode="floor")
 
     # Calculate the constituent pt, eta and phi
-    eta = csts[..., 0]
-    phi = csts[..., 1]
-    pt = csts[..., 2].exp()
+    eta, phi, pt = csts.reshape(-1, csts.shape[-1]).index_select(0, cst_idx).T
+    eta, phi, pt = eta.to(dtype), phi.to(dtype), pt.to(dtype)
+    if pt_logged:
+        pt = pt.exp()
 
-    # Calculate the total jet values in cartensian coordinates, include mask for sum
-    jet_px = (pt * T.cos(phi) * mask).sum(axis=-1)
-    jet_py = (pt * T.sin(phi) * mask).sum(axis=-1)
-    jet_pz = (pt * T.sinh(eta) * mask).sum(axis=-1)
-    jet_e = (pt * T.cosh(eta) * mask).sum(axis=-1)
+    # The hyperbolic functions share a single exponential
+    exp_eta = eta.exp()
+    inv_exp_eta = exp_eta.reciprocal()
+    four_mom = T.stack(
+        [
+            pt * phi.cos(),
+            pt * phi.sin(),
+            0.5 * pt * (exp_eta - inv_exp_eta),
+            0.5 * pt * (exp_eta + inv_exp_eta),
+        ],
+        dim=-1,
+    )
+
+    # Sum the four-momenta of the constituents into their jets at once
+    jet_mom = T.zeros((len(csts), 4), dtype=dtype, device=csts.device)
+    jet_px, jet_py, jet_pz, jet_e = jet_mom.index_add(0, jet_idx, four_mom).T
 
     # Get the derived jet values, the clamps ensure NaNs dont occur
     jet_pt = T.clamp_min(jet_px**2 + jet_py**2, 0).sqrt()
     jet_m = T.clamp_min(jet_e**2 - jet_px**2 - jet_py**2 - jet_pz**2, 0).sqrt()
 
-    return T.vstack([jet_pt, jet_m]).T
+    return T.stack([jet_pt, jet_m], dim=-1)
+
+
+def locals_to_mass_and_pt(csts: T.Tensor, mask: T.BoolTensor) -> T.Tensor:
+    """Calculate the overall jet pt and mass from the constituents with log_pt,
+    see jet_kinematics."""
+    return jet_kinematics(csts, mask, pt_logged=True)
 
 
 def numpy_locals_to_mass_and_pt(
@@ -39,29 +107,6 @@ def numpy_locals_to_mass_and_pt(
     mask: np.ndarray,
     pt_logged=False,
 ) -> np.ndarray:
-    """Calculate the overall jet pt and mass from the constituents. The
-    constituents are expected to be expressed as:
-
-    - del_eta
-    - del_phi
-    - log_pt or just pt depending on pt_logged
-    """
-
-    # Calculate the constituent pt, eta and phi
-    eta = csts[..., 0]
-    phi = csts[..., 1]
-    pt = np.exp(csts[..., 2]) * mask if pt_logged else csts[..., 2]
-
-    # Calculate the total jet values in cartensian coordinates, include mask for sum
-    jet_px = (pt * np.cos(phi) * mask).sum(axis=-1)
-    jet_py = (pt * np.sin(phi) * mask).sum(axis=-1)
-    jet_pz = (pt * np.sinh(eta) * mask).sum(axis=-1)
-    jet_e = (pt * np.cosh(eta) * mask).sum(axis=-1)
-
-    # Get the derived jet values, the clamps ensure NaNs dont occur
-    jet_pt = np.sqrt(np.clip(jet_px**2 + jet_py**2, 0, None))
-    jet_m = np.sqrt(
-        np.clip(jet_e**2 - jet_px**2 - jet_py**2 - jet_pz**2, 0, None)
-    )
-
-    return np.vstack([jet_pt, jet_m]).T
+    """Calculate the overall jet pt and mass from the constituents as numpy
+    arrays, see jet_kinematics."""
+    return jet_kinematics(csts, mask, pt_logged)
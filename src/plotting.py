@@ -6,9 +6,59 @@ from typing import Optional, Union
 import matplotlib.pyplot as plt
 import numpy as np
 import PIL
-import wandb
 from jetnet.utils import efps
 
+from src.physics import jet_kinematics
+
+# Fixed bin edges of the marginals, the values are clipped to these ranges
+CST_BINS = [
+    np.linspace(-0.5, 0.5, 51),
+    np.linspace(-0.5, 0.5, 51),
+    np.linspace(0, 1, 51),
+]
+JET_BINS = [np.linspace(0, 0.4, 51), np.linspace(0, 4e-3, 51)]
+
+
+def multi_histogram(
+    data: np.ndarray,
+    bins: list,
+    incl_overflow: bool = True,
+    incl_underflow: bool = True,
+) -> list:
+    """Histogram each column of a 2D array using fixed bin edges.
+
+    Each column takes a single bincount of its bin indices. For evenly spaced
+    edges the indices are calculated directly, otherwise with a binary search.
+    As in numpy the final bin includes its upper edge.
+
+    Args:
+        data: The array of shape (N, n_cols)
+        bins: The bin edges for each column
+        incl_overflow: Include the values above the final edge in the last bin
+        incl_underflow: Include the values below the first edge in the first bin
+
+    Returns:
+        A list of the counts in each column
+    """
+    hists = []
+    for col, edges in zip(data.T, bins):
+        n_bins = len(edges) - 1
+        widths = np.diff(edges)
+        if np.allclose(widths, widths[0]):
+            idx = np.floor((col - edges[0]) / widths[0])
+        else:
+            idx = np.searchsorted(edges, col, side="right") - 1.0
+        idx[col == edges[-1]] = n_bins - 1
+
+        # Move the overflow into the edge bins or remove it
+        if incl_underflow:
+            idx = np.maximum(idx, 0)
+        if incl_overflow:
+            idx = np.minimum(idx, n_bins - 1)
+        idx = idx[(idx >= 0) & (idx < n_bins)]
+        hists.append(np.bincount(idx.astype(np.int64), minlength=n_bins))
+    return hists
+
 
 def plot_multi_hists(
     data_list: Union[list, np.ndarray],
@@ -34,6 +84,7 @@ def plot_multi_hists(
     do_ratio_to_first: bool = False,
     return_fig: bool = False,
     return_img: bool = False,
+    hists: Optional[list] = None,
 ) -> Union[plt.Figure, None]:
     """Plot multiple histograms given a list of 2D tensors/arrays.
 
@@ -66,6 +117,9 @@ def plot_multi_hists(
         as_pdf: Also save an additional image in pdf format
         return_fig: Return the figure (DOES NOT CLOSE IT!)
         return_img: Return a PIL image (will close the figure)
+        hists: Precomputed counts of each column for the entries of data_list (eg:
+            from multi_histogram), the entries of data_list may then be None.
+            Requires the bin edges to be given
     """
 
     # Make the arguments lists for generality
@@ -75,8 +129,9 @@ def plot_multi_hists(
         data_labels = [data_labels]
     if isinstance(col_labels, str):
         col_labels = [col_labels]
-    if not isinstance(bins, list):
-        bins = data_list[0].shape[-1] * [bins]
+    bins = list(bins) if isinstance(bins, list) else len(col_labels) * [bins]
+    if not isinstance(hists, list):
+        hists = len(data_list) * [hists]
     if not isinstance(scale_factors, list):
         scale_factors = len(data_list) * [scale_factors]
     if not isinstance(hist_kwargs, list):
@@ -86,15 +141,16 @@ def plot_multi_hists(
 
     # Cycle through the datalist and ensure that they are 2D, as each column is an axis
     for data_idx in range(len(data_list)):
-        if data_list[data_idx].ndim < 2:
+        if data_list[data_idx] is not None and data_list[data_idx].ndim < 2:
             data_list[data_idx] = data_list[data_idx].unsqueeze(-1)
 
     # Check the number of histograms to plot
     n_data = len(data_list)
-    n_axis = data_list[0].shape[-1]
+    n_axis = len(col_labels)
 
     # Make sure that all the list lengths are consistant
     assert len(data_labels) == n_data
+    assert len(hists) == n_data
     assert len(col_labels) == n_axis
     assert len(bins) == n_axis
 
@@ -134,11 +190,20 @@ def plot_multi_hists(
                 ax_bins = np.insert(ax_bins, 0, unq.min() + unq.min() - ax_bins[0])
 
         # Numpy function to get the bin edges, catches all other cases (int, etc)
-        ax_bins = np.histogram_bin_edges(data_list[0][:, ax_idx], bins=ax_bins)
+        if np.ndim(ax_bins) == 0:
+            ax_bins = np.histogram_bin_edges(data_list[0][:, ax_idx], bins=ax_bins)
+        ax_bins = np.asarray(ax_bins)
 
         # Replace the element in the array with the edges
         bins[ax_idx] = ax_bins
 
+    # Histogram all columns of each 2D array in a single pass
+    for data_idx in range(n_data):
+        if hists[data_idx] is None and data_list[data_idx].ndim == 2:
+            hists[data_idx] = multi_histogram(
+                data_list[data_idx], bins, incl_overflow, incl_underflow
+            )
+
     # Cycle through each of the axes
     for ax_idx in range(n_axis):
 
@@ -148,27 +213,28 @@ def plot_multi_hists(
         # Cycle through each of the data arrays
         for data_idx in range(n_data):
 
-            # Apply overflow and underflow (make a copy)
-            data = np.copy(data_list[data_idx][..., ax_idx]).squeeze()
-            if incl_overflow:
-                data = np.minimum(data, ax_bins[-1])
-            if incl_underflow:
-                data = np.maximum(data, ax_bins[0])
+            # Use the counts which were already calculated
+            if hists[data_idx] is not None:
+                hist = hists[data_idx][ax_idx].astype(float)
+                if do_norm:
+                    hist /= hist.sum() * np.diff(ax_bins)
+                hist_err = np.sqrt(hist)
 
-            # If the data is still a 2D tensor treat it as a collection of histograms
-            if data.ndim > 1:
-                h = []
-                for dim in range(data.shape[-1]):
-                    h.append(np.histogram(data[:, dim], ax_bins, density=do_norm)[0])
+            # Otherwise the 3D tensor is treated as a collection of histograms
+            else:
+                data = data_list[data_idx][..., ax_idx]
+                h = np.array(
+                    multi_histogram(
+                        data, data.shape[-1] * [ax_bins], incl_overflow, incl_underflow
+                    ),
+                    dtype=float,
+                )
+                if do_norm:
+                    h /= h.sum(axis=-1, keepdims=True) * np.diff(ax_bins)
 
                 # Nominal and err is based on chi2 of same value, mult measurements
-                hist = 1 / np.mean(1 / np.array(h), axis=0)
-                hist_err = np.sqrt(1 / np.sum(1 / np.array(h), axis=0))
-
-            # Otherwise just calculate a single histogram
-            else:
-                hist, _ = np.histogram(data, ax_bins, density=do_norm)
-                hist_err = np.sqrt(hist)
+                hist = 1 / np.mean(1 / h, axis=0)
+                hist_err = np.sqrt(1 / np.sum(1 / h, axis=0))
 
             # Apply the scale factors
             if scale_factors[data_idx] is not None:
@@ -294,9 +360,8 @@ def plot_multi_hists(
 
     # Return a rendered image, or the matplotlib figure, or close
     if return_img:
-        img = PIL.Image.frombytes(
-            "RGB", fig.canvas.get_width_height(), fig.canvas.tostring_rgb()
-        )
+        fig.canvas.draw()
+        img = PIL.Image.fromarray(np.asarray(fig.canvas.buffer_rgba())).convert("RGB")
         plt.close(fig)
         return img
     if return_fig:
@@ -304,7 +369,9 @@ def plot_multi_hists(
     plt.close(fig)
 
 
-def locals_to_rel_mass_and_efp(csts: np.ndarray, mask: np.ndarray) -> np.ndarray:
+def locals_to_rel_mass_and_efp(
+    csts: np.ndarray, mask: np.ndarray, jet_efps: Optional[np.ndarray] = None
+) -> np.ndarray:
     """Convert the values of a set of constituents to the relative mass and EFP
     values of the jet they belong to.
 
@@ -314,32 +381,39 @@ def locals_to_rel_mass_and_efp(csts: np.ndarray, mask: np.ndarray) -> np.ndarray
         mask: A numpy array of shape (batch_size, n_csts)
             containing a mask for the constituents, used to sum only over
             the valid constituents.
+        jet_efps: The precomputed EFPs of the jets, calculated here if None.
 
     Returns:
         A numpy array of shape (batch_size, 2)
             containing the relative mass and EFP values of the jet.
     """
 
-    # Calculate the constituent pt, eta and phi
-    eta = csts[..., 0]
-    phi = csts[..., 1]
-    pt = csts[..., 2]
+    # Calculate the jet mass using only the valid constituents
+    jet_m = jet_kinematics(csts, mask)[:, 1]
 
-    # Calculate the total jet values in cartensian coordinates, include mask for sum
-    jet_px = (pt * np.cos(phi) * mask).sum(axis=-1)
-    jet_py = (pt * np.sin(phi) * mask).sum(axis=-1)
-    jet_pz = (pt * np.sinh(eta) * mask).sum(axis=-1)
-    jet_e = (pt * np.cosh(eta) * mask).sum(axis=-1)
+    # Get the efp values
+    if jet_efps is None:
+        jet_efps = efps(csts, efp_jobs=1)
 
-    # Get the derived jet values, the clamps ensure NaNs dont occur
-    jet_m = np.sqrt(
-        np.clip(jet_e**2 - jet_px**2 - jet_py**2 - jet_pz**2, 0, None)
-    )
+    return np.vstack([jet_m, jet_efps.mean(axis=-1)]).T
 
-    # Get the efp values
-    jet_efps = efps(csts, efp_jobs=1).mean(axis=-1)
 
-    return np.vstack([jet_m, jet_efps]).T
+def marginal_histograms(
+    csts: np.ndarray, mask: np.ndarray, jet_efps: Optional[np.ndarray] = None
+) -> dict:
+    """Histogram the constituent and jet marginals of a set of jets using the
+    fixed bins, the values are clipped to the expected jet spread first.
+
+    Returns:
+        A dictionary of the counts for the "csts" and "jets" marginals
+    """
+    csts = np.clip(csts, [-0.5, -0.5, 0], [0.5, 0.5, 1])
+    jets = locals_to_rel_mass_and_efp(csts, mask, jet_efps)
+    jets = np.nan_to_num(np.clip(jets, 0, [0.4, 4e-3]))
+    return {
+        "csts": multi_histogram(csts[mask], CST_BINS),
+        "jets": multi_histogram(jets, JET_BINS),
+    }
 
 
 def plot_mpgan_marginals(
@@ -347,48 +421,47 @@ def plot_mpgan_marginals(
     nodes: np.ndarray,
     mask: np.ndarray,
     current_epoch: int,
-) -> None:
+    output_efps: Optional[np.ndarray] = None,
+    node_efps: Optional[np.ndarray] = None,
+    node_hists: Optional[dict] = None,
+) -> tuple:
+    """Plot the constituent and jet marginals of the generated and real jets.
+
+    The EFPs of the jets can be passed if they were already calculated. The
+    histograms of the real jets can also be passed (see marginal_histograms) as
+    they do not change between epochs, then only the generated jets are binned.
 
-    # Clip the outputs for the marginals to match expected jet spread
-    outputs[..., 0] = np.clip(outputs[..., 0], -0.5, 0.5)
-    outputs[..., 1] = np.clip(outputs[..., 1], -0.5, 0.5)
-    outputs[..., 2] = np.clip(outputs[..., 2], 0, 1)
+    Returns:
+        The PIL images of the constituent and jet histograms
+    """
+    output_hists = marginal_histograms(outputs, mask, output_efps)
+    if node_hists is None:
+        node_hists = marginal_histograms(nodes, mask, node_efps)
 
     # Plot histograms for the constituent marginals
     Path("./plots/").mkdir(parents=False, exist_ok=True)
     cst_img = plot_multi_hists(
-        data_list=[nodes[mask], outputs[mask]],
+        data_list=[None, None],
         data_labels=["Original", "Generated"],
         col_labels=[r"$\Delta \eta$", r"$\Delta \phi$", r"$\frac{p_T}{Jet_{p_T}}$"],
         do_norm=True,
+        bins=CST_BINS,
         return_img=True,
         path=f"./plots/csts_{current_epoch}",
         logy=True,
+        hists=[node_hists["csts"], output_hists["csts"]],
     )
 
-    # Convert to total jet mass and pt, do some clamping to make everyone happy
-    pred_jets = locals_to_rel_mass_and_efp(outputs, mask)
-    pred_jets[:, 0] = np.clip(pred_jets[:, 0], 0, 0.4)
-    pred_jets[:, 1] = np.clip(pred_jets[:, 1], 0, 4e-3)
-    pred_jets = np.nan_to_num(pred_jets)
-
-    real_jets = locals_to_rel_mass_and_efp(nodes, mask)
-    real_jets[:, 0] = np.clip(real_jets[:, 0], 0, 0.4)
-    real_jets[:, 1] = np.clip(real_jets[:, 1], 0, 4e-3)
-    real_jets = np.nan_to_num(real_jets)
-
-    # Image for the total jet variables
+    # Image for the total jet variables, relative mass and mean EFP
     jet_img = plot_multi_hists(
-        data_list=[real_jets, pred_jets],
+        data_list=[None, None],
         data_labels=["Original", "Generated"],
         col_labels=["Relative Jet Mass", "Jet EFP"],
         do_norm=True,
+        bins=JET_BINS,
         return_img=True,
         path=f"./plots/jets_{current_epoch}",
+        hists=[node_hists["jets"], output_hists["jets"]],
     )
 
-    # Create the wandb table and add the data
-    if wandb.run is not None:
-        gen_table = wandb.Table(columns=["constituents", "jets"])
-        gen_table.add_data(wandb.Image(cst_img), wandb.Image(jet_img))
-        wandb.run.log({"generated": gen_table}, commit=False)
+    return cst_img, jet_img
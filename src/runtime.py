@@ -0,0 +1,85 @@
+"""Generation using a denoiser exported by scripts/export.py.
+
+Only pytorch is needed, the model is loaded without pytorch lightning, hydra,
+wandb, jetnet or matplotlib and the samplers are shared with the full model.
+"""
+
+import json
+from pathlib import Path
+from typing import Optional, Union
+
+import torch as T
+
+from src.models.diffusion import VPDiffusionSchedule, run_sampler
+
+
+class ExportedGenerator:
+    """Runs the samplers of src.models.diffusion using an exported TorchScript
+    denoiser, matching TransformerDiffusionGenerator.full_generation."""
+
+    def __init__(self, path: Union[Path, str], device: str = "cpu") -> None:
+        """
+        Args:
+            path: The file written by scripts/export.py
+            device: Where to load the network and run the generation
+        """
+        extra_files = {"config.json": ""}
+        self.module = T.jit.load(
+            str(path), map_location=device, _extra_files=extra_files
+        )
+        self.module.eval()
+        self.config = json.loads(extra_files["config.json"])
+        self.device = T.device(device)
+        self.pc_dim = self.config["pc_dim"]
+        self.ctxt_dim = self.config["ctxt_dim"]
+        self.n_nodes = self.config["n_nodes"]
+        self.diff_sched = VPDiffusionSchedule(**self.config["diff_config"])
+
+    def __call__(
+        self,
+        noisy_data: T.Tensor,
+        diffusion_times: T.Tensor,
+        mask: T.BoolTensor,
+        ctxt_cache: T.Tensor,
+    ) -> T.Tensor:
+        """Estimate the noise in the data, the context must already have been
+        embedded with the module."""
+        return self.module(noisy_data, diffusion_times, mask, ctxt_cache)
+
+    @T.no_grad()
+    def full_generation(
+        self,
+        sampler: str,
+        steps: int,
+        mask: T.BoolTensor,
+        ctxt: Optional[T.Tensor] = None,
+        initial_noise: Optional[T.Tensor] = None,
+        **sampler_kwargs,
+    ) -> T.Tensor:
+        """Fully generate a batch of point clouds from noise given the mask and
+        the (unnormalised) context."""
+        if initial_noise is None:
+            initial_noise = T.randn((*mask.shape, self.pc_dim), device=self.device)
+
+        # The context is normalised and embedded only once for all steps
+        if self.ctxt_dim:
+            ctxt_cache = self.module.embed_ctxt(ctxt)
+        else:
+            ctxt_cache = T.zeros((len(mask), 0), device=self.device)
+
+        # Run the sampling method with this object in place of the model
+        outputs, _ = run_sampler(
+            sampler,
+            self,
+            self.diff_sched,
+            initial_noise=initial_noise * mask.unsqueeze(-1),
+            n_steps=steps,
+            mask=mask,
+            ctxt=ctxt_cache,
+            clip_predictions=(-25, 25),
+            **sampler_kwargs,
+        )
+
+        # Ensure that the output adheres to the mask and undo the normalisation
+        outputs[~mask] = 0
+        return self.module.reverse(outputs, mask)
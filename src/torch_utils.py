@@ -1,4 +1,4 @@
-from typing import Union
+from typing import Optional, Union
 
 import numpy as np
 import torch as T
@@ -30,3 +30,83 @@ def to_np(inpt: Union[T.Tensor, tuple]) -> np.ndarray:
     if inpt.dtype == T.bfloat16:  # Numpy conversions don't support bfloat16s
         inpt = inpt.half()
     return inpt.detach().cpu().numpy()
+
+
+class BatchBuffer:
+    """Collects batches of tensors into preallocated host memory.
+
+    Each batch is copied straight into its slice of the buffers. When the
+    batches are on the GPU the buffers are pinned and the copies do not block,
+    so there is no synchronisation for each batch. The filled arrays are then
+    available as views without any concatenation.
+    """
+
+    def __init__(self, capacity: int = 0) -> None:
+        """
+        Args:
+            capacity: The number of samples to allocate for, grows if exceeded
+        """
+        self.capacity = capacity
+        self.buffers = None
+        self.n_filled = 0
+        self._copy_event = None
+
+    def reset(self, capacity: Optional[int] = None) -> None:
+        """Empty the buffers, the memory is kept unless the capacity changes."""
+        if capacity is not None and capacity != self.capacity:
+            self.capacity = capacity
+            self.buffers = None
+        self.n_filled = 0
+
+    def append(self, *tensors: T.Tensor) -> None:
+        """Copy a batch of tensors, all with the same length, into the buffers."""
+        n_new = len(tensors[0])
+        if self.buffers is None or self.n_filled + n_new > self.capacity:
+            self._allocate(tensors, self.n_filled + n_new)
+        for buffer, tensor in zip(self.buffers, tensors):
+            buffer[self.n_filled : self.n_filled + n_new].copy_(
+                tensor.detach(), non_blocking=True
+            )
+        self.n_filled += n_new
+
+        # Record when the copies are done so they can be waited on later
+        if tensors[0].is_cuda:
+            self._copy_event = T.cuda.Event()
+            self._copy_event.record()
+
+    def _allocate(self, tensors: tuple, min_capacity: int) -> None:
+        """Create the buffers, doubling the capacity and keeping the contents of
+        any old ones once the copies into them have finished."""
+        if self.buffers is not None:
+            min_capacity = max(min_capacity, 2 * self.capacity)
+        capacity = max(self.capacity, min_capacity)
+        buffers = [
+            T.empty(
+                (capacity, *tensor.shape[1:]),
+                dtype=T.half if tensor.dtype == T.bfloat16 else tensor.dtype,
+                pin_memory=tensor.is_cuda,
+            )
+            for tensor in tensors
+        ]
+        if self.buffers is not None:
+            self._wait()
+            for new, old in zip(buffers, self.buffers):
+                new[: self.n_filled] = old[: self.n_filled]
+        self.buffers = buffers
+        self.capacity = capacity
+
+    def arrays(self) -> tuple:
+        """Wait for any copies and return numpy views of the filled buffers."""
+        self._wait()
+        if self.buffers is None:
+            return ()
+        return tuple(b[: self.n_filled].numpy() for b in self.buffers)
+
+    def _wait(self) -> None:
+        """Block until the non blocking copies into the buffers are finished."""
+        if self._copy_event is not None:
+            self._copy_event.synchronize()
+            self._copy_event = None
+
+    def __len__(self) -> int:
+        return self.n_filled
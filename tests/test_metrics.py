@@ -0,0 +1,29 @@
+import numpy as np
+
+from src.metrics import w1m, w1p
+
+
+def random_jets(n_jets: int, seed: int) -> np.ndarray:
+    """Random jets in the jetnet format (eta, phi, pt) with some zero padding."""
+    rng = np.random.default_rng(seed)
+    jets = rng.normal(size=(n_jets, 30, 3)) * [0.1, 0.1, 0.05]
+    jets[..., 2] = np.abs(jets[..., 2])
+    jets[:, 20:] = 0
+    return jets
+
+
+def test_bootstrap_seeded_rng() -> None:
+    jets1, jets2 = random_jets(200, 0), random_jets(200, 1)
+    for fn in [w1m, w1p]:
+        first = fn(jets1, jets2, num_eval_samples=100, rng=np.random.default_rng(3))
+        second = fn(jets1, jets2, num_eval_samples=100, rng=np.random.default_rng(3))
+        np.testing.assert_array_equal(first, second)
+
+
+def test_bootstrap_global_seed() -> None:
+    jets1, jets2 = random_jets(200, 0), random_jets(200, 1)
+    results = []
+    for _ in range(2):
+        np.random.seed(12345)
+        results.append(w1p(jets1, jets2, num_eval_samples=100))
+    np.testing.assert_array_equal(results[0], results[1])
@@ -0,0 +1,18 @@
+import torch as T
+
+from src.models.modules import IterativeNormLayer
+
+
+def test_fit_stream_matches_fit() -> None:
+    T.manual_seed(0)
+    inpt = T.randn(100, 30, 3) * T.tensor([1.0, 2.0, 5.0]) + 3
+    mask = T.rand(100, 30) > 0.3
+
+    fitted = IterativeNormLayer((3,))
+    fitted.fit(inpt, mask)
+    streamed = IterativeNormLayer((3,))
+    streamed.fit_stream((inpt[i : i + 7], mask[i : i + 7]) for i in range(0, 100, 7))
+
+    for name in ["means", "vars", "m2", "n"]:
+        T.testing.assert_close(getattr(streamed, name), getattr(fitted, name))
+    assert streamed.frozen and fitted.frozen